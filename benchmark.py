@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+"""
+benchmark.py - Scaling benchmark for unix_auto_new.py
+
+Generates synthetic ksh job scripts (JobStep sections, stamp subsections,
+functions, nested for/while/case blocks and keyword lines), times every stage
+of the processing pipeline over a sweep of script sizes and keyword counts,
+and writes a JSON report. A previous report can be passed with --baseline to
+flag stages that got slower.
+
+Example:
+    python3 benchmark.py --lines 1000 10000 100000 --keywords 10 1000 -o bench.json
+"""
+
+import argparse
+import json
+import platform
+import random
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+
+import unix_auto_new as ua
+
+BASE_KEYWORDS = [
+    "GetFileArrDTM", "Template", "Sort", "getfilebypass", "GetMinMaxValues",
+    "GetTransNode", "RefreshZonemap", "ChunkSql", "db_chunk_size", "db2_connect",
+    "db2_disconnect", "db2_load", "db2_sql", "Sqlstats",
+]
+
+FILLER_COMMANDS = [
+    "SqlExecute -u od_sec -t oracle -f $bindir/$vScript.step.sql -l $log",
+    "Runworkflow -f UDM_STG -s wf_m_dly_optns_quots -e 1 -l $log",
+    "PurgeIntervalPartitions -u od_sec -t $vTgtTable -l $log",
+    "ControlMaxid -d oracle -u od_sec -t $vTgtTable -c DLY_ID",
+    "VFILECHECK=$(zcat $datadir/$vSrcFile | head -1)",
+    "Checkrc -r $?",
+    "cp $datadir/$vSrcFile $tmpdir/$vSrcFile.bdi_bak",
+    "# cat $datadir/$vScript.parm >> $tmpdir/$vScript.param",
+]
+
+def make_keywords(count, seed=0):
+    """Return `count` keywords: the real migration list padded with synthetic names."""
+    rng = random.Random(seed)
+    keywords = BASE_KEYWORDS[:count]
+    while len(keywords) < count:
+        keywords.append(f"Legacy{rng.choice(['Db', 'Sql', 'Zone', 'Node'])}Call{len(keywords)}")
+    return keywords
+
+def generate_script(target_lines, keywords, subsections=3, functions_per_100_sections=20,
+                    depth=2, keyword_density=0.05, seed=0, sections=None):
+    """Generate a synthetic ksh script of roughly `target_lines` lines.
+
+    Each section holds `subsections` stamp blocks; every block nests
+    for/while/case constructs `depth` levels deep. `keyword_density` is the
+    fraction of command lines that call one of `keywords`. With `sections`
+    the script has exactly that many sections and `target_lines` is ignored.
+    """
+    rng = random.Random(seed)
+    lines = [
+        "#!/bin/ksh\n",
+        "# SCRIPT: synthetic_benchmark.sh\n",
+        "# Purpose: generated by benchmark.py\n",
+        "#\n",
+        "# REVISIONS HISTORY\n",
+        "# 01/01/2025  bench        Initial Release\n",
+        "\n",
+        ". $HOME/profile_bdi\n",
+        "Init -f multi -s bdi_benchmark\n",
+        "\n",
+    ]
+
+    def command(indent):
+        if rng.random() < keyword_density:
+            return f"{indent}{rng.choice(keywords)} -l $log\n"
+        return f"{indent}{rng.choice(FILLER_COMMANDS)}\n"
+
+    def block(indent, level):
+        """Emit a nested loop/case block `level` levels deep."""
+        body = []
+        kind = rng.choice(("for", "while", "case"))
+        inner = indent + "    "
+        if kind == "case":
+            body.append(f"{indent}case $APP_ENV in\n")
+            for pattern in ("DEV)", "PROD | PRODUCTION)", "*)"):
+                body.append(f"{inner}{pattern}\n")
+                body.append(command(inner + "    "))
+                if level > 1 and pattern == "DEV)":
+                    body.extend(block(inner + "    ", level - 1))
+                body.append(f"{inner}    ;;\n")
+            body.append(f"{indent}esac\n")
+        else:
+            header = "for vFile in $vFileList; do" if kind == "for" else "while read vRow; do"
+            body.append(f"{indent}{header}\n")
+            body.append(command(inner))
+            if level > 1:
+                body.extend(block(inner, level - 1))
+            body.append(command(inner))
+            body.append(f"{indent}done\n")
+        return body
+
+    section = 0
+    lines.append("function MainProcess {\n")
+    while section < sections if sections else len(lines) < target_lines:
+        section += 1
+        lines.append(f'    if JobStep "Section {section}: Generated step {section}"; then\n')
+        for sub in range(1, subsections + 1):
+            lines.append(f'        stamp "Section {section}.{sub}: Generated subsection" >> $log\n')
+            lines.append(command("        "))
+            if depth:
+                lines.extend(block("        ", depth))
+            lines.append(command("        "))
+        lines.append("    fi\n")
+        lines.append("\n")
+        if rng.random() * 100 < functions_per_100_sections:
+            lines.append("}\n")
+            lines.append("\n")
+            lines.append(f"function helper{section} {{\n")
+            lines.append(f'    stamp "Helper {section}" >> $log\n')
+            lines.append(command("    "))
+            if depth:
+                lines.extend(block("    ", depth))
+            lines.append("    return 0\n")
+            lines.append("}\n")
+            lines.append("\n")
+            lines.append(f"function MainProcess{section} {{\n")
+    lines.append("}\n")
+    lines.append("MainProcess\n")
+    lines.append("exit 0\n")
+    return lines
+
+def time_pipeline(lines, matcher):
+    """Run every processing stage on `lines` and return per-stage wall times in seconds."""
+    timer = ua.StageTimer(trace_memory=False)
+    ua.transform_lines(lines, matcher, timer)
+    return {record['stage']: record['seconds'] for record in timer.report()}
+
+def run_sweep(line_counts, keyword_counts, shape, repeat, seed, section_counts=None):
+    """Time every script size and keyword count; `shape` holds generate_script's layout options.
+
+    With `section_counts` the sizes are swept by number of sections instead
+    of `line_counts`.
+    """
+    runs = []
+    for keyword_count in keyword_counts:
+        keywords = make_keywords(keyword_count, seed)
+        started = time.perf_counter()
+        matcher = ua.KeywordMatcher(keywords)
+        compile_time = time.perf_counter() - started
+        for size in section_counts or line_counts:
+            if section_counts:
+                script = generate_script(0, keywords, sections=size, seed=seed, **shape)
+            else:
+                script = generate_script(size, keywords, seed=seed, **shape)
+            best = None
+            for _ in range(repeat):
+                timings = time_pipeline(list(script), matcher)
+                if best is None or sum(timings.values()) < sum(best.values()):
+                    best = timings
+            total = sum(best.values())
+            print(f"lines={len(script):>8} keywords={keyword_count:>6} total={total:8.3f}s  "
+                  f"slowest={max(best, key=best.get)}", file=sys.stderr)
+            runs.append({
+                'lines': len(script),
+                'keywords': keyword_count,
+                'matcher_compile': compile_time,
+                'stages': best,
+                'total': total,
+            })
+    return runs
+
+def compare_reports(report, baseline, tolerance):
+    """Return descriptions of stages slower than the baseline by more than `tolerance`."""
+    previous = {(run['lines'], run['keywords']): run for run in baseline.get('runs', [])}
+    regressions = []
+    for run in report['runs']:
+        old = previous.get((run['lines'], run['keywords']))
+        if old is None:
+            continue
+        for stage, seconds in run['stages'].items():
+            before = old['stages'].get(stage)
+            # Ignore stages too fast to time reliably
+            if before is None or max(before, seconds) < 0.005:
+                continue
+            if seconds > before * (1 + tolerance):
+                regressions.append(f"{stage} at {run['lines']} lines/{run['keywords']} keywords: "
+                                   f"{before:.4f}s -> {seconds:.4f}s")
+    return regressions
+
+def parse_args():
+    p = argparse.ArgumentParser(description="Benchmark the shell script automation tool")
+    p.add_argument("--lines", type=int, nargs="+", default=[1000, 10000, 100000],
+                   help="Approximate script sizes to generate")
+    p.add_argument("--keywords", type=int, nargs="+", default=[10, 100, 1000],
+                   help="Keyword list sizes to test")
+    p.add_argument("--sections", type=int, nargs="+", default=None,
+                   help="Sweep exact section counts instead of --lines")
+    p.add_argument("--subsections", type=int, default=3, help="Stamp subsections per section")
+    p.add_argument("--functions", type=int, default=20,
+                   help="Helper functions per 100 sections")
+    p.add_argument("--depth", type=int, default=2, help="Nesting depth of for/while/case blocks")
+    p.add_argument("--density", type=float, default=0.05,
+                   help="Fraction of command lines that use a keyword")
+    p.add_argument("--repeat", type=int, default=1, help="Runs per configuration (best is kept)")
+    p.add_argument("--seed", type=int, default=0, help="Random seed for script generation")
+    p.add_argument("-o", "--output", type=Path, default=None, help="Write the JSON report here")
+    p.add_argument("--baseline", type=Path, default=None,
+                   help="Previous JSON report to compare against")
+    p.add_argument("--tolerance", type=float, default=0.25,
+                   help="Allowed slowdown per stage before it is reported as a regression")
+    p.add_argument("--emit-script", type=Path, default=None,
+                   help="Only write one generated script (first --lines or --sections and "
+                        "--keywords value) and exit")
+    return p.parse_args()
+
+def main():
+    args = parse_args()
+
+    shape = {'subsections': args.subsections, 'functions_per_100_sections': args.functions,
+             'depth': args.depth, 'keyword_density': args.density}
+
+    if args.emit_script:
+        keywords = make_keywords(args.keywords[0], args.seed)
+        script = generate_script(args.lines[0], keywords, seed=args.seed,
+                                 sections=args.sections[0] if args.sections else None, **shape)
+        args.emit_script.write_text("".join(script), encoding="utf-8")
+        print(f"Wrote {len(script)} lines to {args.emit_script}")
+        return
+
+    report = {
+        'tool_version': ua.TOOL_VERSION,
+        'python': platform.python_version(),
+        'generated': datetime.now().isoformat(timespec='seconds'),
+        'config': {'sections': args.sections, 'subsections': args.subsections,
+                   'functions_per_100_sections': args.functions, 'depth': args.depth,
+                   'density': args.density, 'seed': args.seed},
+        'runs': run_sweep(args.lines, args.keywords, shape, args.repeat, args.seed, args.sections),
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        args.output.write_text(text + "\n", encoding="utf-8")
+        print(f"Report written to: {args.output}")
+    else:
+        print(text)
+
+    if args.baseline:
+        regressions = compare_reports(report, json.loads(args.baseline.read_text(encoding="utf-8")),
+                                      args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION: {regression}")
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
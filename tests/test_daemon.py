@@ -0,0 +1,95 @@
+import socket
+import threading
+import time
+
+import pytest
+
+import unix_auto_new as ua
+
+pytestmark = pytest.mark.skipif(not hasattr(socket, "AF_UNIX"), reason="needs Unix domain sockets")
+
+SCRIPT = ('#!/bin/ksh\nif JobStep "Section 1: load"; then\n    stamp "Section 1.1: step" >> $log\n'
+          '    db2_connect -d x\n    echo bdi_home\nfi\n')
+
+
+@pytest.fixture
+def daemon(tmp_path):
+    keywords = tmp_path / "keywords.txt"
+    keywords.write_text("db2_connect\n", encoding="utf-8")
+    cache = ua.ResultCache(tmp_path / "cache", max_bytes=0)
+    server = ua.ProcessingDaemon(tmp_path / "d.sock", keywords, jobs=2, cache=cache)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+
+def test_pipelined_responses_keep_request_order(daemon, tmp_path):
+    scripts = []
+    for k in range(6):
+        path = tmp_path / f"job{k}.sh"
+        path.write_text(SCRIPT, encoding="utf-8")
+        scripts.append(path)
+    requests = [{'script': str(path), 'patch': k % 2 == 1} for k, path in enumerate(scripts)]
+    requests.insert(3, {'script': str(tmp_path / "missing.sh")})
+    responses = ua.submit(daemon.socket_path, requests)
+    assert [response['ok'] for response in responses] == [True] * 3 + [False] + [True] * 3
+    assert "missing.sh" in responses[3]['error'] and "No such file" in responses[3]['error']
+    assert [response['result']['script'] for k, response in enumerate(responses) if k != 3] == \
+        [str(path) for path in scripts]
+    assert responses[1]['result']['output'].endswith("job1.sh.patch")
+    # The cache is trimmed to its limit once the client is done
+    deadline = time.time() + 5
+    while any(daemon.cache.directory.iterdir()) and time.time() < deadline:
+        time.sleep(0.05)
+    assert not any(daemon.cache.directory.iterdir())
+
+
+def test_request_options_are_applied(daemon, tmp_path):
+    path = tmp_path / "job.sh"
+    path.write_text(SCRIPT, encoding="utf-8")
+    rules = tmp_path / "rules.txt"
+    rules.write_text("bdi -> xyz\n", encoding="utf-8")
+    bad_rules = tmp_path / "bad.txt"
+    bad_rules.write_text("no arrow\n", encoding="utf-8")
+    responses = ua.submit(daemon.socket_path, [{'script': str(path), 'rules': str(rules)},
+                                               {'script': str(path), 'rules': str(bad_rules)}])
+    assert "xyz_home" in (tmp_path / "job_modified.sh").read_text(encoding="utf-8")
+    assert not responses[1]['ok'] and "expected 'pattern -> replacement'" in responses[1]['error']
+
+
+def test_a_live_socket_is_not_taken_over(daemon, tmp_path):
+    with pytest.raises(OSError, match="already listening"):
+        ua.ProcessingDaemon(daemon.socket_path, tmp_path / "keywords.txt", jobs=1)
+    assert ua.submit(daemon.socket_path, [{'command': 'ping'}])[0]['ok']
+
+
+def test_a_stale_socket_is_replaced(tmp_path):
+    path = tmp_path / "stale.sock"
+    stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    stale.bind(str(path))
+    stale.close()
+    (tmp_path / "keywords.txt").write_text("db2_connect\n", encoding="utf-8")
+    server = ua.ProcessingDaemon(path, tmp_path / "keywords.txt", jobs=1)
+    server.server_close()
+
+
+def test_submit_sends_every_request_before_reading(tmp_path):
+    path = tmp_path / "fake.sock"
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(str(path))
+    listener.listen(1)
+
+    def answer_after_all():
+        conn, _ = listener.accept()
+        with conn, conn.makefile("rwb") as stream:
+            count = sum(1 for _ in stream)
+            stream.write(b'{"ok": true}\n' * count)
+
+    server = threading.Thread(target=answer_after_all, daemon=True)
+    server.start()
+    assert ua.submit(path, [{'command': 'ping'}] * 50) == [{'ok': True}] * 50
+    server.join()
+    listener.close()
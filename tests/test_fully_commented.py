@@ -0,0 +1,54 @@
+import unix_auto_new as ua
+
+
+def nested_sections(depth):
+    lines = []
+    for k in range(1, depth + 1):
+        lines += [f'if JobStep "Section {k}: d"; then\n', f'    stamp "Section {k}.1: s" >> $log\n',
+                  "    db2_connect -d x\n"]
+    return lines + ["fi\n"] * depth
+
+
+def run(lines, capsys, timer=None):
+    result = ua.transform_lines(lines, ua.KeywordMatcher(["db2_connect"]), timer, report_only=True)
+    capsys.readouterr()
+    return result
+
+
+def fully_commented_seconds(lines, capsys):
+    best = None
+    for _ in range(3):
+        timer = ua.StageTimer(trace_memory=False)
+        run(lines, capsys, timer)
+        seconds = next(row['seconds'] for row in timer.report() if row['stage'] == 'fully_commented')
+        best = seconds if best is None else min(best, seconds)
+    return best
+
+
+def test_fully_commented_nested_sections_reach_the_outermost(capsys):
+    result = run(nested_sections(5), capsys)
+    assert result['fully_commented_sections'] == set(range(1, 6))
+
+
+def test_deep_nesting_examines_each_block_a_bounded_number_of_times(capsys, monkeypatch):
+    examined = []
+    check = ua._block_fully_commented
+
+    def counting(node, *args):
+        examined.append(node.kind)
+        return check(node, *args)
+
+    monkeypatch.setattr(ua, "_block_fully_commented", counting)
+    for depth in (50, 200):
+        examined.clear()
+        sections = run(nested_sections(depth), capsys)['structure']['sections']
+        blocks = len(sections) + sum(len(section['subsections']) for section in sections)
+        assert len(examined) <= 3 * blocks
+
+
+def test_deep_nesting_scales_with_the_number_of_blocks(capsys):
+    # Doubling the depth gives four times the blocks: every stamp is a
+    # subsection of each section around it
+    small = fully_commented_seconds(nested_sections(100), capsys)
+    large = fully_commented_seconds(nested_sections(200), capsys)
+    assert large < 10 * small
@@ -0,0 +1,54 @@
+import pytest
+
+import unix_auto_new as ua
+
+
+def load(tmp_path, text):
+    path = tmp_path / "keywords.txt"
+    path.write_text(text, encoding="utf-8")
+    return ua.load_keywords(path)
+
+
+def test_literals_match_substrings():
+    matcher = ua.KeywordMatcher(["db2_connect", "db2", "Sort"])
+    assert matcher.scan("x db2_connectasas\n") == (["db2_connect", "db2"], False)
+    assert matcher.scan("Sort -k1\n") == (["Sort"], True)
+    assert matcher.find_all("echo hi\n") == []
+
+
+def test_globs_match_whole_words():
+    matcher = ua.KeywordMatcher(["db2_*", "Get?ransNode"])
+    assert matcher.find_all("db2_load x; GetTransNode\n") == ["db2_*", "Get?ransNode"]
+    assert matcher.find_all("xdb2_load GetTransNodes\n") == []
+
+
+def test_regex_hits_count_as_whole_words():
+    matcher = ua.KeywordMatcher([r"re:^\s*ftp"])
+    assert matcher.scan("  ftp put\n") == ([r"re:^\s*ftp"], True)
+
+
+def test_regex_entries_with_the_same_group_number():
+    matcher = ua.KeywordMatcher(["Sort", r"re:(a)\1", r"re:(b)\1"])
+    assert matcher.find_all("bb\n") == [r"re:(b)\1"]
+    assert matcher.find_all("aa Sort\n") == ["Sort", r"re:(a)\1"]
+    assert matcher.find_all("ab\n") == []
+
+
+def test_regex_entries_with_the_same_group_name(tmp_path):
+    entries = ["re:(?P<x>db2)_(?P=x)", "re:(?P<x>ora)_(?P=x)"]
+    assert load(tmp_path, ", ".join(entries)) == entries
+    matcher = ua.KeywordMatcher(entries)
+    assert matcher.find_all("ora_ora\n") == [entries[1]]
+    assert matcher.occurrences("db2_db2 ora_ora\n") == {entries[0]: True, entries[1]: True}
+
+
+@pytest.mark.parametrize("text", ["Sort, *", "Sort, re:(db2_)?x*", "Sort, re:db2_(", "re:(?i)db2"])
+def test_invalid_entries_are_rejected(tmp_path, text):
+    assert load(tmp_path, text) == []
+
+
+def test_profile_matcher_tags_pattern_entries():
+    matcher = ua.ProfileMatcher({'a': ["db2_*", "Sort"], 'b': ["db2_load", r"re:(S)ort\w*"]})
+    indexes = matcher.hit_indexes(["x db2_load\n", "Sorted\n"])
+    assert indexes['a'].hits == {0: ["db2_*"], 1: ["Sort"]}
+    assert indexes['b'].hits == {0: ["db2_load"], 1: [r"re:(S)ort\w*"]}
@@ -0,0 +1,63 @@
+import contextlib
+import io
+import tracemalloc
+
+import unix_auto_new as ua
+
+
+def script(sections):
+    lines = ["#!/bin/ksh\n", "# SCRIPT: job\n", ". $HOME/profile_bdi\n"]
+    for k in range(1, sections + 1):
+        lines += [f'if JobStep "Section {k}: load table {k}"; then\n',
+                  f'    stamp "Section {k}.1: extract" >> $log\n',
+                  f"    cp $datadir/src_{k}.dat $tmpdir/bdi_{k}.dat\n",
+                  f"    for vFile in $vFileList_{k}; do\n",
+                  f"        zcat $datadir/$vFile | head -{k} >> $tmpdir/rows_{k}\n",
+                  "        Checkrc -r $?\n",
+                  "    done\n",
+                  f'    stamp "Section {k}.2: load" >> $log\n',
+                  f"    Runworkflow -f UDM_STG -s wf_m_load_{k} -e 1 -l $log\n",
+                  "    Checkrc -r $?\n",
+                  f"    db2_connect -d warehouse_{k}\n" if k % 20 == 0 else f"    echo loaded {k}\n",
+                  "fi\n", "\n"]
+    return "".join(lines)
+
+
+def allocated(action):
+    """Return (result, bytes still allocated, peak bytes) of running `action` under tracemalloc."""
+    tracemalloc.start()
+    try:
+        result = action()
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, current, peak
+
+
+def test_processing_peak_stays_near_one_copy_of_the_script(tmp_path):
+    path = tmp_path / "job.sh"
+    path.write_text(script(2000), encoding="utf-8")
+    _, copy, _ = allocated(lambda: path.read_text(encoding="utf-8").splitlines(keepends=True))
+    matcher = ua.KeywordMatcher(["db2_connect"])
+
+    def run():
+        with contextlib.redirect_stdout(io.StringIO()):
+            return ua.process_script(path, None, tmp_path / "out.sh", matcher=matcher, prefilter=False)
+
+    # Warm the regular expression cache first; the interpreter's free lists
+    # keep a few thousand small tuples alive afterwards either way
+    run()
+    summary, retained, peak = allocated(run)
+    assert summary['lines_modified'] == 100
+    # The parsed structure and the journal of edits come on top of the text
+    assert peak < 5 * copy
+    assert retained < copy / 4
+
+
+def test_line_metadata_holds_no_text():
+    text = script(2000)
+    lines, copy, _ = allocated(lambda: text.splitlines(keepends=True))
+    meta, size, _ = allocated(lambda: ua.build_line_meta(lines))
+    assert meta[4].content == 'stamp "Section 1.1: extract" >> $log'
+    assert meta[4].indent == "    "
+    assert size < copy
@@ -0,0 +1,66 @@
+import unix_auto_new as ua
+
+
+def nested_cases(depth, body="echo x"):
+    lines = []
+    for k in range(depth):
+        lines += [f"case $v{k} in\n", f"  a{k})\n", f"    {body}\n"]
+    for k in range(depth):
+        lines += ["    ;;\n", "esac\n"]
+    return lines
+
+
+def script():
+    lines = ["#!/bin/ksh\n", "function load {\n", "  for f in a b; do\n", "    db2_load $f\n", "  done\n", "}\n",
+             'if JobStep "Section 1: run"; then\n', '  stamp "Section 1.1: step" >> $log\n',
+             "  while read x; do\n", "    echo $x\n", "  done\n", "fi\n"]
+    return lines + nested_cases(3, "db2_load y") + ["case $z in\n", "esac\n"] + nested_cases(2)
+
+
+def test_lazy_parse_keeps_the_blocks_around_hits():
+    lines = script()
+    hits = ua.HitIndex(lines, ua.KeywordMatcher(["db2_load"]))
+    lazy = ua.parse_structure(lines, hits=hits)
+    full = ua.link_structure(ua.plain_structure(ua.parse_structure(lines)), hits)
+    assert ua.plain_structure(lazy) == ua.plain_structure(full)
+    assert [loop['type'] for loop in lazy['loops']] == ['for', 'case', 'case', 'case']
+    # The branchless case is kept, the cases after it without hits are not
+    assert [case['start'] for case in lazy['cases']] == [12, 15, 18, 27]
+
+
+def test_nested_case_branches_are_classified_once(monkeypatch):
+    calls = []
+    event = ua._branch_event
+    monkeypatch.setattr(ua, "_branch_event", lambda *args: calls.append(1) or event(*args))
+    lines = nested_cases(200, "db2_load y")
+    structure = ua.parse_structure(lines, hits=ua.HitIndex(lines, ua.KeywordMatcher(["db2_load"])))
+    assert len(structure['cases']) == 200
+    assert len(calls) <= len(lines)
+
+
+def test_cases_without_hits_read_only_up_to_their_first_branch(monkeypatch):
+    calls = []
+    event = ua._branch_event
+    monkeypatch.setattr(ua, "_branch_event", lambda *args: calls.append(1) or event(*args))
+    lines = nested_cases(200)
+    structure = ua.parse_structure(lines, hits=ua.HitIndex(lines, ua.KeywordMatcher(["db2_load"])))
+    assert structure['cases'] == []
+    assert len(calls) <= 4 * 200
+
+
+def test_cache_parses_a_miss_with_the_given_meta(tmp_path, monkeypatch):
+    lines = script()
+    meta = ua.build_line_meta(lines)
+    hits = ua.HitIndex(lines, ua.KeywordMatcher(["db2_load"]))
+    expected = ua.plain_structure(ua.parse_structure(lines, meta, hits))
+    cache = ua.ResultCache(tmp_path)
+    key = cache.structure_key("".join(lines).encode("utf-8"))
+
+    def no_meta(lines):
+        raise AssertionError("line metadata rebuilt")
+
+    monkeypatch.setattr(ua, "build_line_meta", no_meta)
+    assert ua.plain_structure(cache.structure(key, lines, meta, hits)) == expected
+    # The stored entry is the full parse, filtered by the hits of each run
+    assert ua.plain_structure(cache.structure(key, lines, meta, hits)) == expected
+    assert len(cache.structure(key, lines, meta)['cases']) == 6
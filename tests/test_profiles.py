@@ -0,0 +1,72 @@
+import io
+import contextlib
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+import unix_auto_new as ua
+
+
+def script(sections):
+    lines = ["#!/bin/ksh\n", "# SCRIPT job\n", "VAR=bdi_home\n"]
+    for k in range(1, sections + 1):
+        lines += [f'if JobStep "Section {k}: load"; then\n', f'    stamp "Section {k}.1: step" >> $log\n',
+                  f"    cp bdi_{k} target      echo done\n", f"    db2_load_{k} -d x\n", "fi\n"]
+    return lines
+
+
+def without_timestamp(text):
+    return re.sub(r"# Generated on: .*", "", text)
+
+
+def test_rendering_on_the_base_matches_a_full_run():
+    lines = script(20)
+    processor = ua.ScriptProcessor(lines)
+    base = processor.base()
+    for keywords in (["db2_load_3"], ["db2_load_1", "db2_load_20"], ["db2_load_*"]):
+        matcher = ua.KeywordMatcher(keywords)
+        result = processor.process(matcher)
+        with contextlib.redirect_stdout(io.StringIO()):
+            expected = ua.transform_lines(lines, matcher)
+        assert without_timestamp("".join(processor.iter_lines(result, base=base))) == \
+            without_timestamp("".join(expected['lines']))
+        assert result['global_replacements'] == expected['global_replacements']
+        assert result['replacement_counts'] == expected['replacement_counts']
+
+
+def test_profiles_without_hits_share_the_base(tmp_path):
+    path = tmp_path / "job.sh"
+    path.write_text("".join(script(3)), encoding="utf-8")
+    profiles = ua.ProfileMatcher({"none": ["zz_missing"], "other": ["yy_missing"], "one": ["db2_load_2"]})
+    report = ua.evaluate_profiles(path, profiles, output_dir=tmp_path / "out")
+    assert report['profiles']['none']['lines_modified'] == 0
+    assert report['profiles']['one']['lines_modified'] == 1
+    none = (tmp_path / "out" / "none" / "job.sh").read_text(encoding="utf-8")
+    assert none == (tmp_path / "out" / "other" / "job.sh").read_text(encoding="utf-8")
+    assert "bdi" not in none
+
+
+def test_profile_work_follows_its_edits(monkeypatch):
+    processor = ua.ScriptProcessor(script(2000))
+    base = processor.base()
+    steps = []
+    step = ua._indent_step
+    monkeypatch.setattr(ua, "_indent_step", lambda *args: steps.append(1) or step(*args))
+    result = processor.process(ua.KeywordMatcher(["db2_load_1000"]))
+    output = list(processor.iter_lines(result, base=base))
+    assert len(output) > 10000
+    # Besides the changelog only the commented line is re-indented
+    changelog = next(k for k, line in enumerate(output) if line.startswith("# END OF CHANGELOG"))
+    assert len(steps) <= changelog + 3
+
+
+def test_messages_stay_with_their_result_across_threads(capsys):
+    lines = ["#!/bin/ksh\n"]
+    for k in range(1, 9):
+        lines += [f'if JobStep "Section {k}: load"; then\n', f'    stamp "Section {k}.1: step" >> $log\n',
+                  f"    db2_load_{k} -d x\n", "fi\n"]
+    processor = ua.ScriptProcessor(lines)
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        results = list(pool.map(lambda k: processor.apply(ua.KeywordMatcher([f"db2_load_{k}"])), range(1, 9)))
+    assert [result['messages'] for result in results] == \
+        [[f"Section {k} is fully commented - commenting header/footer"] for k in range(1, 9)]
+    assert capsys.readouterr().out == ""
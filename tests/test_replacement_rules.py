@@ -0,0 +1,66 @@
+from pathlib import Path
+
+import pytest
+
+import unix_auto_new as ua
+
+
+def rules(*specs):
+    return ua.ReplacementRules({'kind': kind, 'pattern': pattern, 'replacement': replacement}
+                               for kind, pattern, replacement in specs)
+
+
+def apply(rule_set, text):
+    lines = [text]
+    rule_set.apply(lines)
+    return lines[0]
+
+
+def load(tmp_path, text):
+    path = tmp_path / "rules.txt"
+    path.write_text(text, encoding="utf-8")
+    return ua.load_replacement_rules(path)
+
+
+def test_backreference_in_only_rule():
+    assert apply(rules(('regex', r'(a)\1', 'Y')), "xaa\n") == "xY\n"
+
+
+def test_backreference_next_to_other_rules():
+    rule_set = rules(('literal', 'bdi', 'war'), ('regex', r'(a)\1', 'Y'), ('regex', r'(b)\1', r'<\1>'))
+    assert apply(rule_set, "bdi xaa bb\n") == "war xY <b>\n"
+
+
+def test_group_names_do_not_clash():
+    rule_set = rules(('literal', 'q', 'Q'), ('regex', r'(?P<r1>z)(?P=r1)', 'Z'), ('regex', r'(?P<r1>y)', r'\g<r1>!'))
+    assert apply(rule_set, "zz y q\n") == "Z y! Q\n"
+
+
+def test_first_listed_rule_wins_at_a_position():
+    rule_set = rules(('regex', r'db2_\w+', 'ORA'), ('literal', 'db2_load', 'LOAD'))
+    assert apply(rule_set, "db2_load x\n") == "ORA x\n"
+    rule_set = rules(('literal', 'db2_load', 'LOAD'), ('regex', r'db2_\w+', 'ORA'))
+    assert apply(rule_set, "db2_load db2_sql\n") == "LOAD ORA\n"
+
+
+def test_counts_per_rule():
+    rule_set = rules(('literal', '_bdi_', 'war'), ('regex', r'b(d)i', r'w\1r'))
+    lines = ["a_bdi_b bdi bdi\n"]
+    assert rule_set.apply(lines) == (1, [1, 2])
+    assert lines == ["awarb wdr wdr\n"]
+
+
+@pytest.mark.parametrize("text", ["re:x* -> Y\n", "re:(db2_)? -> Y\n", "word: -> Y\n", "re: -> Y\n"])
+def test_empty_matching_rules_are_rejected(tmp_path, text):
+    assert load(tmp_path, text) is None
+
+
+def test_prefixes_stop_at_the_first_match(tmp_path):
+    rule_set = load(tmp_path, "word:re:bdi -> war\n")
+    assert rule_set.rules == [{'kind': 'word', 'pattern': 're:bdi', 'replacement': 'war'}]
+    assert apply(rule_set, "re:bdi bdi\n") == "war bdi\n"
+
+
+def test_rules_file(tmp_path):
+    rule_set = load(tmp_path, "# comment\n_bdi_ -> war\nword:Template -> NewTemplate\nre:db2_(\\w+) -> ora_\\1\n")
+    assert apply(rule_set, "x_bdi_ Template Templates db2_load\n") == "xwar NewTemplate Templates ora_load\n"
@@ -0,0 +1,42 @@
+import unix_auto_new as ua
+
+
+def nested_sections(depth):
+    lines = ["#!/bin/ksh\n"]
+    for k in range(1, depth + 1):
+        lines += [f'if JobStep "Section {k}: d"; then\n', f'    stamp "Section {k}.1: s" >> $log\n',
+                  "    db2_connect -d x\n", "    echo keep\n"]
+    return lines + ["fi\n"] * depth
+
+
+def test_enclosing_skips_blocks_that_already_ended():
+    lines = nested_sections(30)
+    index = ua.StructureIndex(ua.parse_structure(lines), len(lines))
+    for i in range(len(lines)):
+        expected = [node for node in index.nodes if node['start'] <= i <= node['end']]
+        assert sorted(node['id'] for node in index.enclosing(i)) == [node['id'] for node in expected]
+
+
+def test_nested_attributions_are_capped_in_reports(tmp_path):
+    path = tmp_path / "job.sh"
+    path.write_text("".join(nested_sections(60)), encoding="utf-8")
+    report = ua.report_script(path, None, matcher=ua.KeywordMatcher(["db2_connect"]))
+    # Each hit is attributed to the subsections of every section around it
+    assert report['keyword_match_counts'] == {'db2_connect': report['lines_modified']}
+    assert report['lines_modified'] > ua.REPORT_MATCH_LIMIT
+    assert len(report['keyword_matches']['db2_connect']) == ua.REPORT_MATCH_LIMIT
+    # The full run still lists every match
+    result = ua.transform_lines(nested_sections(60), ua.KeywordMatcher(["db2_connect"]))
+    assert len(result['stats']['keyword_matches']['db2_connect']) == report['lines_modified']
+
+
+def test_scripts_without_keywords_are_not_parsed(tmp_path):
+    path = tmp_path / "job.sh"
+    path.write_text("".join(nested_sections(3)), encoding="utf-8")
+    matcher = ua.KeywordMatcher(["sqlplus"])
+    full = ua.report_script(path, None, matcher=matcher, prefilter=False)
+    report = ua.report_script(path, None, matcher=matcher, timings=True)
+    assert report['prefilter'] == 'skipped'
+    assert report['lines'] == full['lines'] == 16
+    assert report['lines_modified'] == full['lines_modified'] == 0
+    assert [row['lines'] for row in report['timings'] if row['stage'] == 'structure'] == [0]
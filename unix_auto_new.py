@@ -11,48 +11,666 @@ Features:
 """
 
 import re
+import io
+import os
+import glob
+import json
+import marshal
+import time
+import hashlib
+import errno
+import functools
+import shutil
+import bisect
+import collections
 import argparse
+import contextlib
+import itertools
+import mmap
+import tracemalloc
+import socket
+import sqlite3
+import socketserver
+import queue
+import threading
 import sys
+from concurrent.futures import Future, ProcessPoolExecutor
 from pathlib import Path
 from datetime import datetime
 
+# Bump whenever processing output changes so cached results are invalidated
+TOOL_VERSION = "2.4.0"
+
+DEFAULT_CACHE_DIR = Path.home() / ".cache" / "unix_auto"
+DEFAULT_CACHE_MAX_MB = 256
+DEFAULT_RULES_PATH = Path(__file__).parent / "replacements.txt"
+DEFAULT_INDEX_PATH = Path.home() / ".cache" / "unix_auto" / "keywords.sqlite"
+
 def parse_args():
     p = argparse.ArgumentParser(description="Complete shell script automation tool")
-    p.add_argument("script", type=Path, help="Input .sh script")
+    p.add_argument("script", type=Path, nargs="*",
+                   help="Input .sh script(s); directories and glob patterns run in batch mode")
     # Remove keywords argument, always use keywords.txt
     p.add_argument("-o", "--output", type=Path, default=None, help="Output file")
     p.add_argument("-v", "--verbose", action="store_true", help="Verbose output")
+    p.add_argument("-j", "--jobs", type=int, default=None,
+                   help="Worker processes for batch mode (default: CPU count)")
+    p.add_argument("--no-cache", action="store_true",
+                   help="Always reprocess scripts instead of reusing cached results")
+    p.add_argument("--cache-dir", type=Path, default=DEFAULT_CACHE_DIR,
+                   help=f"Result cache directory (default: {DEFAULT_CACHE_DIR})")
+    p.add_argument("--cache-max-mb", type=int, default=DEFAULT_CACHE_MAX_MB,
+                   help="Evict least recently used cache entries above this size")
+    p.add_argument("--report-only", "--dry-run", dest="report_only", action="store_true",
+                   help="Only detect structures and keyword hits; print a JSON impact report instead of writing output")
+    p.add_argument("--timings", action="store_true",
+                   help="Report wall time, lines touched and peak memory per stage (bypasses cache lookups)")
+    p.add_argument("--patch", action="store_true",
+                   help="Write a unified diff of the edits (default: <script>.patch) instead of the full script")
+    p.add_argument("--rules", type=Path, default=None,
+                   help="Global replacement rule file (default: replacements.txt next to this script, "
+                        "else 'bdi' variants → 'war')")
+    p.add_argument("--reindent", choices=("all", "touched"), default="all",
+                   help="Re-indent the whole script, or only blocks changed by commenting/renumbering")
+    p.add_argument("--no-prefilter", dest="prefilter", action="store_false",
+                   help="Fully process scripts even when they contain no keyword at all")
+    p.add_argument("--journal", type=Path, default=None,
+                   help="Also export the ordered edit journal as JSON (single-script mode)")
+    p.add_argument("--serve", type=Path, metavar="SOCKET", default=None,
+                   help="Run as a daemon listening on this Unix socket, keeping keyword matchers warm")
+    p.add_argument("--submit", type=Path, metavar="SOCKET", default=None,
+                   help="Send the scripts to a daemon started with --serve instead of processing locally")
+    p.add_argument("--profile", type=Path, default=None,
+                   help="Keyword file the daemon should use for submitted scripts (default: its keywords.txt)")
+    p.add_argument("--profiles", type=Path, nargs="+", metavar="KEYWORDS", default=None,
+                   help="Evaluate several keyword files against one parse of each script and print "
+                        "per-profile summaries (or impact reports with --report-only) as JSON")
+    p.add_argument("--profile-outputs", type=Path, metavar="DIR", default=None,
+                   help="With --profiles, also write each profile's modified script to DIR/<profile>/")
+    p.add_argument("--build-index", action="store_true",
+                   help="Index every token occurrence of the scripts, with its enclosing blocks, in --index-db")
+    p.add_argument("--query", nargs="+", metavar="KEYWORD", default=None,
+                   help="Print the indexed locations of these tokens (or glob patterns) as JSON")
+    p.add_argument("--index-db", type=Path, default=DEFAULT_INDEX_PATH,
+                   help=f"SQLite keyword-occurrence index (default: {DEFAULT_INDEX_PATH})")
     args = p.parse_args()
-    # If output is not specified, generate it from input script
-    if args.output is None:
-        stem = args.script.stem
-        suffix = args.script.suffix
-        parent = args.script.parent
-        output_name = f"{stem}_modified{suffix}" if suffix else f"{stem}_modified"
-        args.output = parent / output_name
     # Always use keywords.txt in the script's directory
     args.keywords = Path(__file__).parent / "keywords.txt"
+    # Replacement rules default to replacements.txt there, if present; only
+    # rules given explicitly override a daemon's own
+    args.rules_given = args.rules is not None
+    if args.rules is None and DEFAULT_RULES_PATH.exists():
+        args.rules = DEFAULT_RULES_PATH
+    if args.serve is not None or args.query is not None:
+        return args
+    if not args.script:
+        p.error("the following arguments are required: script")
+    # A single plain file keeps the one-script flow; anything else is a batch
+    args.batch = (len(args.script) > 1 or args.script[0].is_dir() or
+                  glob.has_magic(str(args.script[0])))
+    # Report-style runs print JSON, which -o redirects
+    reporting = args.report_only or args.profiles or args.build_index
+    if args.batch and args.output is not None and not reporting:
+        p.error("-o/--output cannot be used with multiple scripts")
+    if args.profile_outputs is not None and not args.profiles:
+        p.error("--profile-outputs requires --profiles")
+    if args.submit is not None:
+        for flag, value in (("--journal", args.journal), ("--timings", args.timings),
+                            ("--profiles", args.profiles), ("--build-index", args.build_index)):
+            if value:
+                p.error(f"{flag} cannot be used with --submit")
+    if not args.batch:
+        args.script = args.script[0]
+        # If output is not specified, generate it from input script
+        if args.output is None and not reporting:
+            args.output = patch_output_path(args.script) if args.patch else default_output_path(args.script)
     return args
 
+def load_replacement_rules(path):
+    """Load global replacement rules, one `pattern -> replacement` per line.
+
+    A `word:` prefix on the pattern matches it only as a whole word and `re:`
+    makes it a regular expression; otherwise it is a literal. Blank lines and
+    lines starting with '#' are ignored. Returns a ReplacementRules, or None
+    if the file cannot be read or has an invalid rule.
+    """
+    try:
+        text = path.read_text(encoding="utf-8")
+        rules = []
+        for line_num, line in enumerate(text.splitlines(), 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            pattern, arrow, replacement = line.partition(" ->")
+            if not arrow:
+                raise ValueError(f"line {line_num}: expected 'pattern -> replacement'")
+            kind = 'literal'
+            for prefix, prefix_kind in (("word:", 'word'), ("re:", 'regex')):
+                if pattern.startswith(prefix):
+                    kind, pattern = prefix_kind, pattern[len(prefix):]
+                    break
+            rules.append({'kind': kind, 'pattern': pattern.strip(), 'replacement': replacement.strip()})
+        return ReplacementRules(rules)
+    except (OSError, ValueError, re.error) as e:
+        print(f"Error loading replacement rules: {e}")
+        return None
+
 def load_keywords(txt_path):
-    """Load keywords from file."""
+    """Load keywords from file.
+
+    Entries are comma-separated. Entries containing `*`, `?` or `[` are globs
+    and `re:` entries are regular expressions; both only match whole words
+    (see KeywordMatcher). Any other entry is a literal substring. A pattern
+    entry that matches the empty string would hit every line and is rejected.
+    """
     try:
         text = txt_path.read_text(encoding="utf-8")
         keywords = [kw.strip() for kw in text.split(",") if kw.strip()]
+        patterns = False
+        for keyword in keywords:
+            source = keyword_entry_pattern(keyword)
+            if source is not None:
+                patterns = True
+                if re.compile(source).match(""):
+                    raise ValueError(f"keyword entry '{keyword}' matches an empty string")
+        if patterns:
+            # Surface entries that cannot be combined now, not when the first script is read
+            KeywordMatcher(keywords)
         return keywords
     except Exception as e:
         print(f"Error loading keywords: {e}")
         return []
 
-def comment_line(line):
-    """Add comment to a line if not already commented."""
-    if line.lstrip().startswith("#"):
-        return line  # Already commented
-    
-    # Find indentation
-    indent_match = re.match(r'^(\s*)', line)
-    indent = indent_match.group(1) if indent_match else ""
-    content = line.lstrip()
+def _glob_source(glob):
+    """Translate a keyword glob into a regex fragment that stays inside one word."""
+    parts = []
+    i = 0
+    while i < len(glob):
+        ch = glob[i]
+        i += 1
+        if ch == "*":
+            parts.append(r"\w*")
+        elif ch == "?":
+            parts.append(r"\w")
+        elif ch == "[" and "]" in glob[i + 1:]:
+            end = glob.index("]", i + 1)
+            chars = glob[i:end]
+            if chars.startswith("!"):
+                chars = "^" + chars[1:]
+            parts.append("[" + chars.replace("\\", "\\\\") + "]")
+            i = end + 1
+        else:
+            parts.append(re.escape(ch))
+    return "".join(parts)
+
+def keyword_entry_pattern(entry):
+    """Return the regex source of a glob or `re:` keyword entry, or None for a literal."""
+    if entry.startswith("re:"):
+        return entry[len("re:"):]
+    if any(ch in entry for ch in "*?["):
+        return _glob_source(entry)
+    return None
+
+def _trie_pattern(node):
+    """Build a regex fragment from a character trie, preferring the longest match."""
+    alternatives = [re.escape(ch) + _trie_pattern(child) for ch, child in sorted(node.items()) if ch]
+    if not alternatives:
+        return ""
+    body = alternatives[0] if len(alternatives) == 1 else "(?:" + "|".join(alternatives) + ")"
+    if "" in node:
+        body = f"(?:{body})?"
+    return body
+
+class KeywordMatcher:
+    """Single compiled matcher for a keyword list (plain substring semantics).
+
+    All literal keywords are folded into one trie-shaped regex wrapped in a
+    lookahead, so one finditer over a line reports the longest keyword
+    starting at every position. Shorter keywords that are prefixes of that
+    match are added from a precomputed table, which makes the result
+    identical to testing `keyword in line` for every keyword.
+
+    Glob and `re:` entries (see keyword_entry_pattern) join the trie as
+    alternatives of the same lookahead. The line is still scanned once; each
+    entry is only tried on its own at the positions where the combined
+    lookahead matched, anchored there to whole words (`db2_*` matches
+    `db2_load` but not `xdb2_load`). `re:` entries with capturing groups are
+    the exception: their group numbers and names would clash with other
+    entries, so each is searched on its own. Hits are always reported as the
+    source entry, e.g. `db2_*` rather than the `db2_load` it matched.
+    """
+
+    def __init__(self, keywords):
+        self.keywords = list(keywords)
+        self._rank = {}
+        for idx, keyword in enumerate(self.keywords):
+            self._rank.setdefault(keyword, idx)
+        
+        trie = {}
+        self._patterns = []  # (entry, anchored regex) tried where the combined lookahead fires
+        self._grouped = []  # (entry, anchored regex) searched on their own
+        sources = []
+        for keyword in self._rank:
+            source = keyword_entry_pattern(keyword)
+            if source is not None:
+                anchored = re.compile(rf"(?<!\w)(?:{source})(?!\w)")
+                if anchored.groups:
+                    self._grouped.append((keyword, anchored))
+                else:
+                    self._patterns.append((keyword, anchored))
+                    sources.append(source)
+                continue
+            node = trie
+            for ch in keyword:
+                node = node.setdefault(ch, {})
+            node[""] = {}
+        self._anchored = {keyword for keyword, _ in self._patterns + self._grouped}
+        literals = _trie_pattern(trie)
+        self._source = "|".join(([literals] if literals else []) + sources)
+        self._plain = not self._anchored
+        if self._plain:
+            self._pattern = re.compile(f"(?=({self._source}))") if self._rank else None
+            self._literals = None
+        else:
+            # The word anchors stay out of the combined pattern: a leading
+            # lookbehind would stop re from skipping to candidate positions
+            self._pattern = re.compile(f"(?=(?:{self._source}))") if self._source else None
+            self._literals = re.compile(literals) if literals else None
+        self._bytes_pattern = None
+        
+        # Keywords that are a strict prefix of another keyword match at the same position
+        self._prefixes = {
+            keyword: [keyword[:n] for n in range(1, len(keyword)) if keyword[:n] in self._rank]
+            for keyword in self._rank
+        }
+
+    def _matches(self, line):
+        """Yield (entry, start, end) for the keyword entry occurrences in `line`.
+
+        Entries searched on their own only report their first occurrence.
+        """
+        for keyword, pattern in self._grouped:
+            for hit in pattern.finditer(line):
+                if hit.end() > hit.start():
+                    yield keyword, hit.start(), hit.end()
+                    break
+        if self._pattern is None:
+            return
+        for match in self._pattern.finditer(line):
+            start = match.start()
+            if self._plain:
+                longest = match.group(1)
+            else:
+                literal = self._literals and self._literals.match(line, start)
+                longest = literal.group() if literal else None
+            if longest:
+                yield longest, start, start + len(longest)
+                for keyword in self._prefixes[longest]:
+                    yield keyword, start, start + len(keyword)
+            for keyword, pattern in self._patterns:
+                hit = pattern.match(line, start)
+                # Empty matches are never hits (load_keywords rejects such entries)
+                if hit and hit.end() > start:
+                    yield keyword, start, hit.end()
+
+    def find_all(self, line):
+        """Return every keyword entry matching `line`, in keyword-list order."""
+        if not self._rank:
+            return []
+        found = {keyword for keyword, _, _ in self._matches(line)}
+        return sorted(found, key=self._rank.__getitem__)
+
+    def search_bytes(self, data):
+        """Return whether any keyword occurs in the UTF-8 bytes `data` (a bytes-like or mmap).
+
+        Glob and `re:` entries cannot be checked on raw bytes (undecoded line
+        endings, ASCII-only \\w), so matchers with any always report True.
+        """
+        if not self._rank:
+            return False
+        if not self._plain:
+            return True
+        if self._bytes_pattern is None:
+            self._bytes_pattern = re.compile(self._source.encode("utf-8"))
+        return self._bytes_pattern.search(data) is not None
+
+    def first(self, line):
+        """Return the first listed keyword contained in `line`, or None."""
+        hits = self.find_all(line)
+        return hits[0] if hits else None
+
+    def scan(self, line):
+        """Return (keyword entries matching `line`, whether any occurs as a whole word).
+
+        Entries are in keyword-list order. For literal keywords "whole word"
+        means the same \\b boundaries as re.search(rf'\\b{keyword}\\b', line);
+        glob and `re:` entries are anchored to words, so every hit is whole.
+        """
+        if not self._rank:
+            return [], False
+        found = set()
+        whole_word = False
+        for keyword, start, end in self._matches(line):
+            found.add(keyword)
+            if not whole_word:
+                whole_word = keyword in self._anchored or (_at_word_boundary(line, start) and
+                                                           _at_word_boundary(line, end))
+        return sorted(found, key=self._rank.__getitem__), whole_word
+
+    def occurrences(self, line):
+        """Return {keyword entry: whether it occurs as a whole word} for every entry matching `line`."""
+        if not self._rank:
+            return {}
+        found = {}
+        for keyword, start, end in self._matches(line):
+            if not found.get(keyword):
+                found[keyword] = keyword in self._anchored or (_at_word_boundary(line, start) and
+                                                               _at_word_boundary(line, end))
+        return found
+
+class ProfileMatcher:
+    """One compiled matcher for several keyword profiles.
+
+    `profiles` maps a profile name to its keyword list. The union of all
+    keywords is compiled into a single KeywordMatcher and every keyword is
+    tagged with the profiles listing it, so one scan of a script yields the
+    hits of every profile; the work per profile grows with its hits only.
+    """
+
+    def __init__(self, profiles):
+        self.profiles = {name: list(keywords) for name, keywords in profiles.items()}
+        self._ranks = {}
+        self._tags = {}
+        for name, keywords in self.profiles.items():
+            rank = self._ranks[name] = {}
+            for idx, keyword in enumerate(keywords):
+                if keyword not in rank:
+                    rank[keyword] = idx
+                    self._tags.setdefault(keyword, []).append(name)
+        self.matcher = KeywordMatcher(self._tags)
+
+    def hit_indexes(self, lines):
+        """Scan `lines` once and return {profile name: HitIndex}."""
+        indexes = {name: HitIndex() for name in self.profiles}
+        for i, line in enumerate(lines):
+            found = self.matcher.occurrences(line)
+            if not found:
+                continue
+            touched = set()
+            for keyword, whole_word in found.items():
+                for name in self._tags[keyword]:
+                    index = indexes[name]
+                    index.hits.setdefault(i, []).append(keyword)
+                    if whole_word:
+                        index.word_lines.add(i)
+                    touched.add(name)
+            for name in touched:
+                indexes[name].hits[i].sort(key=self._ranks[name].__getitem__)
+        return indexes
+
+def _is_word_char(ch):
+    return ch.isalnum() or ch == "_"
+
+def _at_word_boundary(line, pos):
+    """Equivalent of a regex \\b at position `pos` of `line`."""
+    before = pos > 0 and _is_word_char(line[pos - 1])
+    after = pos < len(line) and _is_word_char(line[pos])
+    return before != after
+
+class HitIndex:
+    """Keyword hits for every line, found by one scan and reused by every stage.
+
+    `hits` maps a line index to the keywords it contains (keyword-list order);
+    `word_lines` holds the lines where at least one keyword is a whole word.
+    Without a matcher the index starts empty (see ProfileMatcher).
+    Hits are recorded against the original text, so commenting a line later
+    does not change its entry.
+    """
+    __slots__ = ('hits', 'word_lines')
+
+    def __init__(self, lines=(), matcher=None):
+        self.hits = {}
+        self.word_lines = set()
+        if matcher is None:
+            return
+        for i, line in enumerate(lines):
+            found, whole_word = matcher.scan(line)
+            if found:
+                self.hits[i] = found
+                if whole_word:
+                    self.word_lines.add(i)
+
+    def first(self, i):
+        """Return the first listed keyword on line i, or None."""
+        found = self.hits.get(i)
+        return found[0] if found else None
+
+    def has(self, i):
+        return i in self.hits
+
+    def has_word(self, i):
+        return i in self.word_lines
+
+LINE_KINDS = {'done': 'done', 'esac': 'esac', 'fi': 'fi', '}': 'brace', ';;': 'case_end'}
+CASE_PATTERN_LINE = re.compile(r'^\s*\w+.*\)\s*$|^\s*\*\)\s*$')
+STAMP_LINE_PATTERN = re.compile(r'^\s*stamp\s+"', re.IGNORECASE)
+
+class LineInfo:
+    """Per-line facts computed once and shared by every processing stage.
+
+    line      -- the line itself
+    indent    -- leading whitespace, as matched by ^\\s*
+    content   -- the stripped line
+    commented -- content starts with '#'
+    kind      -- 'blank', 'comment', 'done', 'esac', 'fi', 'brace', 'case_end',
+                 'case_pattern' or 'code'
+    stamp     -- the line is an uncommented stamp command
+
+    indent and content are sliced from the line when read; only their
+    offsets are stored, so a record holds no text of its own.
+    """
+    __slots__ = ('line', 'start', 'tail', 'commented', 'kind', 'stamp')
+
+    def __init__(self, line):
+        content = line.strip()
+        self.line = line
+        self.start = len(line) - len(line.lstrip())
+        self.tail = len(line) - len(line.rstrip())
+        self.commented = content.startswith("#")
+        if not content:
+            self.kind = 'blank'
+        elif self.commented:
+            self.kind = 'comment'
+        else:
+            self.kind = LINE_KINDS.get(content) or ('case_pattern' if CASE_PATTERN_LINE.match(content) else 'code')
+        self.stamp = not self.commented and STAMP_LINE_PATTERN.match(line) is not None
+
+    @property
+    def indent(self):
+        return self.line[:self.start]
+
+    @property
+    def content(self):
+        return self.line[self.start:len(self.line) - self.tail]
+
+class LineTable(list):
+    """List of LineInfo records parallel to the script lines.
+
+    With `rewrite` off (report-only runs) comment_at only marks lines as
+    commented in the table and leaves the text untouched.
+    """
+    rewrite = True
+
+def build_line_meta(lines):
+    """Build the LineInfo table parallel to `lines`; repeated lines share one record."""
+    records = {}
+    return LineTable(records.get(line) or records.setdefault(line, LineInfo(line)) for line in lines)
+
+class MetaOverlay:
+    """A LineTable view that shares the records of `base` until they are replaced.
+
+    Each keyword run of a ScriptProcessor stores only the records of the
+    lines it rewrites. Splicing records in (the changelog) first turns the
+    view into a full copy.
+    """
+
+    def __init__(self, base):
+        self.base = base
+        self.changed = {}
+        self.rewrite = base.rewrite
+
+    def __len__(self):
+        return len(self.base)
+
+    def __getitem__(self, i):
+        info = self.changed.get(i)
+        return self.base[i] if info is None else info
+
+    def __setitem__(self, i, info):
+        if isinstance(i, slice):
+            self.base = LineTable(self)
+            self.changed = {}
+            self.base[i] = info
+            return
+        self.changed[i] = info
+
+    def append(self, info):
+        self[len(self):len(self)] = [info]
+
+    def __iter__(self):
+        changed = self.changed
+        for i, info in enumerate(self.base):
+            yield changed.get(i, info)
+
+class EditJournal:
+    """The original script lines plus an ordered journal of edits to them.
+
+    Stages use it like a list: assigning lines[i] records a 'replace' edit and
+    assigning a slice records a 'splice' (used to insert the changelog).
+    Indices always refer to the original lines, so splices must come after
+    every replace. `base` is never modified; iterating yields the edited
+    script, built in a single pass. Each edit is tagged with the current
+    `stage` so the journal can be exported with to_records().
+    """
+
+    def __init__(self, base):
+        self.base = base
+        self.edits = []  # (op, index, payload, stage) in the order they were made
+        self.stage = None
+        self._current = {}  # index -> latest replacement text
+        self._splices = []  # (start, stop, block)
+        self._length = len(base)
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self.base)
+        return self._current.get(i, self.base[i])
+
+    def __setitem__(self, i, text):
+        if isinstance(i, slice):
+            start, stop, _ = i.indices(len(self.base))
+            block = list(text)
+            self.splice(start, stop, block)
+            return
+        if i < 0:
+            i += len(self.base)
+        if self._splices:
+            raise ValueError("cannot replace lines after a splice")
+        self._current[i] = text
+        self.edits.append(('replace', i, text, self.stage))
+
+    def splice(self, start, stop, block):
+        """Replace original lines start..stop-1 with `block`."""
+        self._splices.append((start, stop, block))
+        self._splices.sort(key=lambda s: (s[0], s[1]))
+        self._length += len(block) - (stop - start)
+        self.edits.append(('splice', start, (stop, block), self.stage))
+
+    def append(self, text):
+        self.splice(len(self.base), len(self.base), [text])
+
+    def __iter__(self):
+        """Materialize the edited script, one line at a time."""
+        for _, text in self.iter_origins():
+            if text is not None:
+                yield text
+
+    def iter_origins(self):
+        """Yield (original index, text) for every line of the edited script.
+
+        Inserted lines have index None; original lines dropped by a splice are
+        yielded with text None.
+        """
+        pos = 0
+        for start, stop, block in self._splices + [(len(self.base), len(self.base), ())]:
+            for i in range(pos, start):
+                yield i, self._current.get(i, self.base[i])
+            for i in range(max(pos, start), stop):
+                yield i, None
+            for text in block:
+                yield None, text
+            pos = max(pos, stop)
+
+    def edited(self):
+        """Return the original indices with a replace edit, as a set-like view."""
+        return self._current.keys()
+
+    def changed(self):
+        """Return the original indices whose text was replaced, in order."""
+        return sorted(i for i, text in self._current.items() if text != self.base[i])
+
+    def touched(self, stages):
+        """Return the original indices changed by a replace edit from any of `stages`, in order."""
+        indices = {index for op, index, _, stage in self.edits if op == 'replace' and stage in stages}
+        return sorted(i for i in indices if self._current[i] != self.base[i])
+
+    def to_records(self):
+        """Return the journal as JSON-serialisable dicts, with 1-based line numbers."""
+        records = []
+        for op, index, payload, stage in self.edits:
+            if op == 'replace':
+                records.append({'op': op, 'line': index + 1, 'text': payload, 'stage': stage})
+            else:
+                stop, block = payload
+                records.append({'op': op, 'line': index + 1, 'end': stop, 'lines': block, 'stage': stage})
+        return records
+
+# Stand-in record for a line that is only marked as commented
+_MARKED_COMMENTED = LineInfo("# -> **\n")
+
+def set_line(lines, meta, i, text):
+    """Replace lines[i] and refresh its metadata."""
+    lines[i] = text
+    meta[i] = LineInfo(text)
+
+def comment_at(lines, meta, i):
+    """Comment lines[i] in place, keeping the metadata table current."""
+    if not getattr(meta, 'rewrite', True):
+        meta[i] = _MARKED_COMMENTED
+        return
+    set_line(lines, meta, i, comment_line(lines[i], meta[i]))
+
+def comment_line(line, info=None):
+    """Add comment to a line if not already commented.
+
+    `info` is the line's LineInfo, when the caller already has it.
+    """
+    if info is not None:
+        if info.commented:
+            return line  # Already commented
+        indent = info.indent
+        content = line[len(indent):]
+    else:
+        if line.lstrip().startswith("#"):
+            return line  # Already commented
+        
+        # Find indentation
+        indent_match = re.match(r'^(\s*)', line)
+        indent = indent_match.group(1) if indent_match else ""
+        content = line.lstrip()
     
     # Different comment styles
     if content.startswith("if ") or content.strip() == "fi" or content.startswith("function "):
@@ -60,205 +678,341 @@ def comment_line(line):
     else:
         return f"{indent}# {content.rstrip()} -> **\n"
 
-def find_sections(lines):
-    """Find JobStep sections with subsection detection."""
-    sections = []
-    section_pattern = re.compile(r'if\s+JobStep\s+"Section\s+(\d+):\s*([^"]*)"', re.IGNORECASE)
+SECTION_PATTERN = re.compile(r'if\s+JobStep\s+"Section\s+(\d+):\s*([^"]*)"', re.IGNORECASE)
+STAMP_PATTERN = re.compile(r'^\s*stamp\s+"([^"]*)"', re.IGNORECASE)
+FUNCTION_PATTERN = re.compile(r'^\s*(?:function\s+(\w+)|(\w+)\s*\(\s*\))', re.IGNORECASE)
+FUNCTION_BOUNDARY_PATTERN = re.compile(r'^\s*(?:function\s+\w+|\w+\s*\(\s*\))|^\s*if\s+JobStep')
+LOOP_PATTERN = re.compile(r'^\s*(for|while|until|select|case)\s+')
+CASE_OPEN_PATTERN = re.compile(r'^\s*case\b')
+CASE_CLOSE_PATTERN = re.compile(r'^\s*esac\b')
+BRANCH_PATTERN = re.compile(r'^\s*[^#\s].*\)\s*$')
+BRANCH_END_PATTERN = re.compile(r'^\s*;;\s*$')
+# Words a LOOP_PATTERN line's stripped content must start with
+LOOP_WORDS = ('for', 'while', 'until', 'select', 'case')
+# Words every line that opens or closes a loop or case starts with
+LOOP_EVENT_WORDS = LOOP_WORDS + ('done', 'esac')
+
+class _BlockCloser:
+    """Pairs openers with closers in one forward pass.
+
+    Openers raise the depth and closers lower it; a block registered at depth d
+    is closed by the first closer that takes the depth from d back to d - 1,
+    which is exactly where a forward opener/closer count from that block would
+    reach zero. Each block is registered and released once.
+    """
+
+    def __init__(self):
+        self.depth = 0
+        self.waiting = {}
+
+    def open(self, block=None, counted=True):
+        if counted:
+            self.depth += 1
+        if block is not None:
+            self.waiting.setdefault(self.depth, []).append(block)
+
+    def close(self, i):
+        for block in self.waiting.pop(self.depth, ()):
+            block['end'] = i
+        self.depth -= 1
+
+    def release(self, end):
+        """Close every block still open at end of input."""
+        for blocks in self.waiting.values():
+            for block in blocks:
+                block['end'] = end
+        self.waiting.clear()
+
+def _branch_event(line, stripped):
+    """Classify a line as a case branch 'pattern', a branch 'end' or neither (None)."""
+    if stripped.endswith(")") and BRANCH_PATTERN.match(line):
+        return 'pattern'
+    if stripped == ";;" and BRANCH_END_PATTERN.match(line):
+        return 'end'
+    return None
+
+def _case_branches(events):
+    """Build branch spans from a case's (line, event) list: a pattern opens a branch, ';;' or the next pattern ends it."""
+    branches = []
+    branch_start = None
+    for k, event in events:
+        if event == 'pattern':
+            if branch_start is not None:
+                branches.append({'start': branch_start, 'end': k - 1})
+            branch_start = k
+        elif branch_start is not None:
+            branches.append({'start': branch_start, 'end': k})
+            branch_start = None
+    return branches
+
+def _branch_events(lines, meta, spans):
+    """Yield the (line, event) pairs of the lines strictly inside the (start, end) `spans`, given in start order.
+
+    Overlapping spans are read once.
+    """
+    read = -1
+    for start, end in spans:
+        for k in range(max(start, read) + 1, end):
+            event = _branch_event(lines[k], meta[k].content)
+            if event:
+                yield k, event
+        read = max(read, end - 1)
+
+def _has_branch(events):
+    """Whether _case_branches(events) would build any branch, reading no further than the first one."""
+    opened = False
+    for _, event in events:
+        if opened:
+            return True
+        opened = event == 'pattern'
+    return False
+
+def _hit_between(found, lo, hi):
+    """Whether `found` (sorted) has a line in lo..hi inclusive."""
+    k = bisect.bisect_left(found, lo)
+    return k < len(found) and found[k] <= hi
+
+def parse_structure(lines, meta=None, hits=None):
+    """Parse sections, stamp subsections, functions, loops, cases and branches.
+
+    Returns a dict with the flat per-kind lists used by the processing stages
+    ('sections', 'functions', 'loops', 'cases') plus 'nodes', every block in
+    start order with 'kind', 'id', 'parent' and 'children' links.
+
+    Commented and blank lines are skipped, since they never open or close a
+    block, and each block regular expression only runs on lines that can
+    match it.
+    Given `hits` (a HitIndex), discovery is lazy: sections, subsections and
+    functions are still all found, but only loops with a keyword line inside,
+    and cases with a whole-word keyword line or without any branch, are kept,
+    and branches are only resolved inside those cases. The dropped blocks are
+    exactly the ones no later stage would touch.
+    """
+    if meta is None:
+        meta = build_line_meta(lines)
+    last = len(lines) - 1
+    sections, functions, loops, cases = [], [], [], []
+    pending_functions = []
+    section_closer, loop_closer, esac_closer, case_closer = (_BlockCloser() for _ in range(4))
     
-    for i, line in enumerate(lines):
-        if line.lstrip().startswith("#"):
+    for i, info in enumerate(meta):
+        if info.kind == 'blank' or info.commented:
             continue
-        match = section_pattern.search(line)
+        stripped = info.content
+        line = lines[i]
+        
+        # Sections close on the balancing 'fi' of their JobStep 'if'
+        match = SECTION_PATTERN.search(line) if '"' in stripped and 'jobstep' in stripped.lower() else None
         if match:
-            sections.append({
+            section = {
                 'num': int(match.group(1)),
                 'description': match.group(2).strip(),
                 'start': i,
                 'end': None,
                 'subsections': []
-            })
-    
-    # Find end of each section and detect subsections
-    for i, section in enumerate(sections):
-        # Find the closing 'fi' for this section
-        brace_count = 1
-        j = section['start'] + 1
-        
-        while j < len(lines) and brace_count > 0:
-            line = lines[j].strip()
-            if not lines[j].lstrip().startswith("#"):
-                if line.startswith("if "):
-                    brace_count += 1
-                elif line == "fi":
-                    brace_count -= 1
-            j += 1
+            }
+            sections.append(section)
+            section_closer.open(section, counted=stripped.startswith("if "))
+        elif stripped.startswith("if "):
+            section_closer.open()
+        elif stripped == "fi":
+            section_closer.close(i)
         
-        section['end'] = j - 1 if brace_count == 0 else len(lines) - 1
+        # Functions end at the next closing brace, or just before the next function/section
+        if (stripped == "}" or '(' in stripped or stripped.startswith("if")
+                or stripped[:8].lower() == "function"):
+            if pending_functions:
+                if stripped == "}":
+                    end = i
+                elif FUNCTION_BOUNDARY_PATTERN.match(line):
+                    end = i - 1
+                else:
+                    end = None
+                if end is not None:
+                    for function in pending_functions:
+                        function['end'] = end
+                    pending_functions = []
+            match = FUNCTION_PATTERN.match(line)
+            if match:
+                function = {
+                    'name': match.group(1) or match.group(2),
+                    'start': i,
+                    'end': last,
+                    'lines_commented': []
+                }
+                functions.append(function)
+                pending_functions.append(function)
         
-        # Detect subsections (stamp commands)
-        section['subsections'] = find_subsections(lines, section['start'] + 1, section['end'])
+        # Every loop opener nests; for/while/until/select close on 'done', case on 'esac'.
+        # Case statements pair up the same way
+        if stripped.startswith(LOOP_EVENT_WORDS):
+            match = LOOP_PATTERN.match(line) if stripped.startswith(LOOP_WORDS) else None
+            if match:
+                loop = {
+                    'type': match.group(1),
+                    'start': i,
+                    'end': None,
+                    'lines_commented': []
+                }
+                loops.append(loop)
+                is_case = loop['type'] == 'case'
+                loop_closer.open(None if is_case else loop)
+                esac_closer.open(loop if is_case else None)
+            elif stripped == "done":
+                loop_closer.close(i)
+            elif stripped == "esac":
+                esac_closer.close(i)
+            if stripped.startswith("case") and CASE_OPEN_PATTERN.match(line):
+                case = {'start': i, 'end': None, 'branches': []}
+                cases.append(case)
+                case_closer.open(case)
+            elif stripped.startswith("esac") and CASE_CLOSE_PATTERN.match(line):
+                case_closer.close(i)
     
-    return sections
-
-def find_subsections(lines, start, end):
-    """Find subsections marked by stamp commands."""
-    subsections = []
-    stamp_pattern = re.compile(r'^\s*stamp\s+"([^"]*)"', re.IGNORECASE)
+    for closer in (section_closer, loop_closer, esac_closer, case_closer):
+        closer.release(last)
     
-    current_subsection = None
+    if hits is not None:
+        hit_lines = sorted(hits.hits)
+        word_lines = sorted(hits.word_lines)
+        # Loops only matter through keyword lines strictly inside them
+        loops = [loop for loop in loops if _hit_between(hit_lines, loop['start'] + 1, loop['end'] - 1)]
+        # A case without branches is commented as a whole; any other case
+        # matters only with a whole-word keyword line, so that is checked
+        # before its branches are read
+        hit_cases = [case for case in cases if _hit_between(word_lines, case['start'], case['end'])]
+        hit_ids = set(map(id, hit_cases))
+        cases = [case for case in cases if id(case) in hit_ids
+                 or not _has_branch(_branch_events(lines, meta, [(case['start'], case['end'])]))]
+    else:
+        hit_cases = cases
+    # Nested cases share their lines, so each line is classified once
+    events = list(_branch_events(lines, meta, [(case['start'], case['end']) for case in hit_cases]))
+    event_lines = [k for k, _ in events]
+    for case in hit_cases:
+        lo = bisect.bisect_right(event_lines, case['start'])
+        hi = bisect.bisect_left(event_lines, case['end'])
+        case['branches'] = _case_branches(events[lo:hi])
     
-    for i in range(start, end):
-        line = lines[i]
-        match = stamp_pattern.match(line)
-        
-        if match:
-            # Close previous subsection
-            if current_subsection:
-                current_subsection['end'] = i - 1
-                subsections.append(current_subsection)
-            
-            # Start new subsection
-            current_subsection = {
-                'description': match.group(1).strip(),
+    stamp_lines = [i for i, info in enumerate(meta) if info.stamp and STAMP_PATTERN.match(lines[i])]
+    for section in sections:
+        lo = bisect.bisect_left(stamp_lines, section['start'] + 1)
+        hi = bisect.bisect_left(stamp_lines, section['end'])
+        subsections = section['subsections']
+        for i in stamp_lines[lo:hi]:
+            if subsections:
+                subsections[-1]['end'] = i - 1
+            subsections.append({
+                'description': STAMP_PATTERN.match(lines[i]).group(1).strip(),
                 'start': i,
-                'end': end - 1,
+                'end': section['end'] - 1,
                 'lines_commented': []
-            }
-    
-    # Add last subsection
-    if current_subsection:
-        subsections.append(current_subsection)
+            })
     
-    return subsections
+    return {
+        'sections': sections,
+        'functions': functions,
+        'loops': loops,
+        'cases': cases,
+        'nodes': build_structure_tree(sections, functions, loops, cases)
+    }
 
-def find_functions(lines):
-    """Find function definitions."""
-    functions = []
-    func_pattern = re.compile(r'^\s*(?:function\s+(\w+)|(\w+)\s*\(\s*\))', re.IGNORECASE)
-    
-    for i, line in enumerate(lines):
-        if line.lstrip().startswith("#"):
-            continue
-            
-        match = func_pattern.match(line)
-        if match:
-            func_name = match.group(1) or match.group(2)
-            start = i
-            
-            # Find function end - look for closing brace or next function/section
-            end = len(lines) - 1
-            for j in range(i + 1, len(lines)):
-                line_content = lines[j].strip()
-                
-                # Look for closing brace
-                if line_content == "}":
-                    end = j
-                    break
-                
-                # Look for next function or section
-                if (re.match(r'^\s*(?:function\s+\w+|\w+\s*\(\s*\))', lines[j]) or
-                    re.match(r'^\s*if\s+JobStep', lines[j])):
-                    end = j - 1
-                    break
-            
-            functions.append({
-                'name': func_name,
-                'start': start,
-                'end': end,
-                'lines_commented': []
-            })    
-    return functions
+# Keys build_structure_tree adds to every block
+_TREE_KEYS = ('kind', 'id', 'parent', 'children')
 
-def find_loops(lines):
-    """Find all loop structures (for, while, until, select, case) in the script."""
-    loops = []
-    
-    for i, line in enumerate(lines):
-        stripped = line.strip()
-        
-        # Skip commented lines
-        if stripped.startswith("#"):
-            continue
-            
-        # Look for loop starters
-        loop_patterns = [
-            (r'^\s*for\s+', 'for'),
-            (r'^\s*while\s+', 'while'),
-            (r'^\s*until\s+', 'until'),
-            (r'^\s*select\s+', 'select'),
-            (r'^\s*case\s+', 'case')
-        ]
-        
-        for pattern, loop_type in loop_patterns:
-            if re.match(pattern, line):
-                start = i
-                
-                # Find loop end
-                end = len(lines) - 1
-                bracket_count = 1  # We found the opening
-                
-                for j in range(i + 1, len(lines)):
-                    inner_line = lines[j].strip()
-                    
-                    # Count nested loops
-                    for inner_pattern, _ in loop_patterns:
-                        if re.match(inner_pattern, lines[j]):
-                            bracket_count += 1
-                            break
-                    
-                    # Look for closing keywords
-                    if loop_type == 'case' and inner_line == 'esac':
-                        bracket_count -= 1
-                    elif loop_type in ['for', 'while', 'until', 'select'] and inner_line == 'done':
-                        bracket_count -= 1
-                    
-                    if bracket_count == 0:
-                        end = j
-                        break
-                
-                loops.append({
-                    'type': loop_type,
-                    'start': start,
-                    'end': end,
-                    'lines_commented': []
-                })
-                break  # Don't check other patterns for this line
+def _plain_block(block):
+    plain = {key: value for key, value in block.items() if key not in _TREE_KEYS}
+    for key in ('subsections', 'branches'):
+        if key in plain:
+            plain[key] = [_plain_block(child) for child in plain[key]]
+    return plain
+
+def plain_structure(structure):
+    """Return the block lists of a parse_structure result as plain dicts without tree links."""
+    return {key: [_plain_block(block) for block in structure[key]]
+            for key in ('sections', 'functions', 'loops', 'cases')}
+
+def link_structure(blocks, hits=None):
+    """Rebuild a parse_structure result from the plain_structure() of a full parse.
+
+    Given `hits`, only the blocks a lazy parse_structure with the same hits
+    would keep are linked in, so the result equals that parse. `blocks` is
+    used in place.
+    """
+    sections, functions, loops, cases = (blocks[key] for key in ('sections', 'functions', 'loops', 'cases'))
+    if hits is not None:
+        hit_lines = sorted(hits.hits)
+        word_lines = sorted(hits.word_lines)
+        loops = [loop for loop in loops if _hit_between(hit_lines, loop['start'] + 1, loop['end'] - 1)]
+        cases = [case for case in cases
+                 if not case['branches'] or _hit_between(word_lines, case['start'], case['end'])]
+    return {
+        'sections': sections,
+        'functions': functions,
+        'loops': loops,
+        'cases': cases,
+        'nodes': build_structure_tree(sections, functions, loops, cases)
+    }
+
+def build_structure_tree(sections, functions, loops, cases):
+    """Link parsed blocks into a tree; a block's parent is the innermost block open at its start."""
+    kinds = [('section', sections), ('function', functions), ('loop', loops), ('case', cases)]
+    nodes = []
+    for kind, blocks in kinds:
+        for block in blocks:
+            block['kind'] = kind
+            nodes.append(block)
+            children = block.get('subsections') if kind == 'section' else block.get('branches', ())
+            for child in children:
+                child['kind'] = 'subsection' if kind == 'section' else 'branch'
+                nodes.append(child)
+    # Outer blocks first when two blocks start on the same line
+    nodes.sort(key=lambda node: (node['start'], -node['end']))
     
-    return loops
+    stack = []
+    for node_id, node in enumerate(nodes):
+        node['id'] = node_id
+        node['children'] = []
+        while stack and stack[-1]['end'] < node['start']:
+            stack.pop()
+        if stack:
+            node['parent'] = stack[-1]['id']
+            stack[-1]['children'].append(node_id)
+        else:
+            node['parent'] = None
+        stack.append(node)
+    return nodes
 
-def find_case_statements(lines):
-    """Find all case statements and their branches."""
-    cases = []
-    for i, line in enumerate(lines):
-        if re.match(r'^\s*case\b', line) and not line.lstrip().startswith('#'):
-            case_start = i
-            # Find matching esac
-            depth, j = 1, i + 1
-            while j < len(lines) and depth > 0:
-                l = lines[j]
-                if re.match(r'^\s*case\b', l) and not l.lstrip().startswith('#'):
-                    depth += 1
-                elif re.match(r'^\s*esac\b', l) and not l.lstrip().startswith('#'):
-                    depth -= 1
-                j += 1
-            case_end = j - 1
-            # Find branches
-            branches = []
-            branch_start = None
-            for k in range(case_start + 1, case_end):
-                if re.match(r'^\s*[^#\s].*\)\s*$', lines[k]):
-                    if branch_start is not None:
-                        branches.append({'start': branch_start, 'end': k - 1})
-                    branch_start = k
-                elif re.match(r'^\s*;;\s*$', lines[k]):
-                    if branch_start is not None:
-                        branches.append({'start': branch_start, 'end': k})
-                        branch_start = None
-            cases.append({'start': case_start, 'end': case_end, 'branches': branches})
-    return cases
-
-def comment_case_branches_and_cases(lines, cases, keywords):
-    """Comment case branches independently, and comment the whole case if all branches are commented."""
+def copy_structure(structure, ids=None):
+    """Copy a parse_structure result for another keyword run over the same script.
+
+    The stages only record commented lines in the blocks' 'lines_commented'
+    lists, so those are fresh and the rest of each block is copied shallowly.
+    With `ids`, only the blocks with those ids are copied and the others are
+    shared; a section must be listed with any of its subsections.
+    """
+    nodes = structure['nodes']
+    copies = {}
+    for node in (nodes if ids is None else (nodes[node_id] for node_id in ids)):
+        clone = dict(node)
+        if 'lines_commented' in node:
+            clone['lines_commented'] = []
+        copies[id(node)] = clone
+    for clone in copies.values():
+        for key in ('subsections', 'branches'):
+            if key in clone:
+                clone[key] = [copies.get(id(child), child) for child in clone[key]]
+    return {key: [copies.get(id(block), block) for block in structure[key]]
+            for key in ('sections', 'functions', 'loops', 'cases', 'nodes')}
+
+def comment_case_branches_and_cases(lines, cases, hits, meta=None):
+    """Comment case branches independently, and comment the whole case if all branches are commented.
+
+    A branch line counts as a keyword line when `hits` (a HitIndex) records a
+    whole-word keyword on it.
+    """
+    if meta is None:
+        meta = build_line_meta(lines)
     for case in cases:
         all_branches_commented = True
         for branch in case['branches']:
@@ -266,313 +1020,414 @@ def comment_case_branches_and_cases(lines, cases, keywords):
             has_keyword = False
             all_commented = True
             for i in branch_lines:
-                if any(re.search(rf'\b{re.escape(k)}\b', lines[i]) for k in keywords):
+                if hits.has_word(i):
                     has_keyword = True
-                    if not lines[i].lstrip().startswith('#'):
+                    if not meta[i].commented:
                         all_commented = False
                         break
             if has_keyword and all_commented:
                 # Comment the branch pattern and all lines
                 for i in branch_lines:
-                    if not lines[i].lstrip().startswith('#') and lines[i].strip():
-                        lines[i] = comment_line(lines[i])
+                    if not meta[i].commented and meta[i].kind != 'blank':
+                        comment_at(lines, meta, i)
             else:
                 all_branches_commented = False
         # If all branches are commented, comment the whole case
         if all_branches_commented:
             for i in range(case['start'], case['end'] + 1):
-                if not lines[i].lstrip().startswith('#') and lines[i].strip():
-                    lines[i] = comment_line(lines[i])
+                if not meta[i].commented and meta[i].kind != 'blank':
+                    comment_at(lines, meta, i)
+
+class StructureIndex:
+    """Line-to-block lookup over a parse_structure result.
+
+    `innermost[i]` is the id of the most recently opened block that still spans
+    line i, or None. Every other block spanning the line is an ancestor of that
+    block, so enclosing(i) only walks the parent chain. `outer[id]` is the
+    nearest ancestor ending after the block does: overlapping sections and
+    subsections can leave long runs of ancestors that ended earlier, and
+    enclosing(i) jumps over them.
+    """
+
+    def __init__(self, structure, line_count):
+        self._bind(structure)
+        self.outer = [None] * len(self.nodes)
+        for node in self.nodes:
+            # Parents come before their children, so their links are set
+            outer = node['parent']
+            while outer is not None and self.nodes[outer]['end'] <= node['end']:
+                outer = self.outer[outer]
+            self.outer[node['id']] = outer
+        self.innermost = [None] * line_count
+        stack = []
+        pos = 0
+        for i in range(line_count):
+            while pos < len(self.nodes) and self.nodes[pos]['start'] <= i:
+                stack.append(self.nodes[pos])
+                pos += 1
+            while stack and stack[-1]['end'] < i:
+                stack.pop()
+            if stack:
+                self.innermost[i] = stack[-1]['id']
+
+    def _bind(self, structure):
+        self.nodes = structure['nodes']
+        self.section_of = {}
+        for section in structure['sections']:
+            for subsection in section['subsections']:
+                self.section_of[subsection['id']] = section
 
-def process_keyword_matching(lines, keywords, sections, functions, loops, orig_commented):
-    """Process keyword matching with detailed tracking."""
-    new_lines = lines.copy()
+    def rebind(self, structure, ids=None):
+        """Return this index over `structure`, a copy_structure() copy of the one it was built for.
+
+        `ids` are the blocks copied, when only those were.
+        """
+        index = StructureIndex.__new__(StructureIndex)
+        if ids is None:
+            index._bind(structure)
+        else:
+            index.nodes = structure['nodes']
+            index.section_of = dict(self.section_of)
+            for node_id in ids:
+                node = index.nodes[node_id]
+                for subsection in node.get('subsections', ()):
+                    index.section_of[subsection['id']] = node
+        index.innermost = self.innermost
+        index.outer = self.outer
+        return index
+
+    def enclosing(self, i):
+        """Return every block spanning line i, innermost first."""
+        blocks = []
+        node_id = self.innermost[i]
+        while node_id is not None:
+            node = self.nodes[node_id]
+            if node['end'] >= i:
+                blocks.append(node)
+                node_id = node['parent']
+            else:
+                node_id = self.outer[node_id]
+        return blocks
+
+    def owner(self, i, kind):
+        """Return the innermost block of `kind` spanning line i, or None."""
+        return next((node for node in self.enclosing(i) if node['kind'] == kind), None)
+
+def process_keyword_matching(lines, hits, structure, index, orig_commented, meta=None, match_limit=None):
+    """Process keyword matching with detailed tracking.
+
+    Keyword hits come from `hits`, the HitIndex built by the first scan; each is
+    attributed, via the
+    StructureIndex, to every section, subsection, function and loop that claims
+    it. Commenting and keyword-usage stats are recorded in section, function,
+    loop order, one entry per claiming block. Lines are commented in place and
+    `meta` is kept current; `lines` is returned along with the stats.
+    `orig_commented` may be None: every hit is attributed before the first
+    line is commented, so `meta` still has the original state then.
+    With `match_limit`, only the first that many matches of each keyword are
+    listed; 'keyword_match_counts' always has the full count per keyword.
+    """
+    if meta is None:
+        meta = build_line_meta(lines)
+    new_lines = lines
     stats = {
         'modified_sections': set(),
         'modified_functions': set(),
         'modified_loops': set(),
         'keyword_matches': {},
+        'keyword_match_counts': {},
         'lines_modified': 0
     }
     
+    claims = {}  # block id -> hit lines it owns, in line order
+    general = {}  # section id -> hit lines outside its subsections
+    for i in sorted(hits.hits):
+        if orig_commented[i] if orig_commented is not None else meta[i].commented:
+            continue
+        
+        enclosing = index.enclosing(i)
+        line_content = meta[i].content
+        # Sections with one of their subsections around the line
+        in_subsection = {index.section_of[node['id']]['id'] for node in enclosing if node['kind'] == 'subsection'}
+        for node in enclosing:
+            kind = node['kind']
+            if kind == 'subsection':
+                claims.setdefault(node['id'], []).append(i)
+            elif kind == 'section':
+                if not node['start'] < i < node['end']:
+                    continue
+                # Skip lines that are part of subsections
+                if node['id'] not in in_subsection:
+                    general.setdefault(node['id'], []).append(i)
+            elif kind == 'function':
+                # Skip the declaration and closing brace
+                if i > node['start'] and line_content != "}":
+                    claims.setdefault(node['id'], []).append(i)
+            elif kind == 'loop':
+                # Skip loop terminators and non-meaningful lines
+                if (not node['start'] < i < node['end'] or
+                    line_content in ['done', 'esac', ';;'] or
+                    line_content.endswith(')') and not line_content.startswith('stamp')):
+                    continue
+                claims.setdefault(node['id'], []).append(i)
+    
+    overflow = []  # takes the matches past match_limit
+    
+    def comment_hit(i):
+        """Comment line i and return the match list for the keyword it is attributed to."""
+        keyword = hits.first(i)
+        if not meta[i].commented:
+            comment_at(new_lines, meta, i)
+        stats['lines_modified'] += 1
+        counts = stats['keyword_match_counts']
+        counts[keyword] = counts.get(keyword, 0) + 1
+        if keyword not in stats['keyword_matches']:
+            stats['keyword_matches'][keyword] = []
+        matches = stats['keyword_matches'][keyword]
+        if match_limit is not None and len(matches) >= match_limit:
+            overflow.clear()
+            return overflow
+        return matches
+    
     # Process sections and subsections
-    for section in sections:
+    for section in structure['sections']:
         section_modified = False
         
         for subsection in section['subsections']:
-            for i in range(subsection['start'], subsection['end'] + 1):
-                if orig_commented[i]:
-                    continue
-                
-                for keyword in keywords:
-                    if keyword in new_lines[i]:
-                        new_lines[i] = comment_line(new_lines[i])
-                        subsection['lines_commented'].append(i)
-                        section_modified = True
-                        stats['lines_modified'] += 1
-                        
-                        # Track keyword usage
-                        if keyword not in stats['keyword_matches']:
-                            stats['keyword_matches'][keyword] = []
-                        stats['keyword_matches'][keyword].append({
-                            'line_num': i + 1,
-                            'section': section['num'],
-                            'subsection': subsection['description']
-                        })
-                        break
+            for i in claims.get(subsection['id'], ()):
+                comment_hit(i).append({
+                    'line_num': i + 1,
+                    'section': section['num'],
+                    'subsection': subsection['description']
+                })
+                subsection['lines_commented'].append(i)
+                section_modified = True
         
-        # Also check lines outside subsections but inside the section
-        for i in range(section['start'] + 1, section['end']):
-            if orig_commented[i]:
-                continue
-                
-            # Skip lines that are part of subsections
-            in_subsection = any(sub['start'] <= i <= sub['end'] for sub in section['subsections'])
-            if in_subsection:
-                continue
-            
-            for keyword in keywords:
-                if keyword in new_lines[i]:
-                    new_lines[i] = comment_line(new_lines[i])
-                    section_modified = True
-                    stats['lines_modified'] += 1
-                    
-                    if keyword not in stats['keyword_matches']:
-                        stats['keyword_matches'][keyword] = []
-                    stats['keyword_matches'][keyword].append({
-                        'line_num': i + 1,
-                        'section': section['num'],
-                        'subsection': 'General section content'
-                    })
-                    break
+        # Also lines outside subsections but inside the section
+        for i in general.get(section['id'], ()):
+            comment_hit(i).append({
+                'line_num': i + 1,
+                'section': section['num'],
+                'subsection': 'General section content'
+            })
+            section_modified = True
         
         if section_modified:
             stats['modified_sections'].add(section['num'])
     
     # Process functions
-    for function in functions:
-        function_modified = False
-        
-        for i in range(function['start'] + 1, function['end'] + 1):
-            if orig_commented[i]:
-                continue
-            
-            # Skip closing brace
-            if lines[i].strip() == "}":
-                continue
-                
-            for keyword in keywords:
-                if keyword in new_lines[i]:
-                    new_lines[i] = comment_line(new_lines[i])
-                    function['lines_commented'].append(i)
-                    function_modified = True
-                    stats['lines_modified'] += 1
-                    
-                    if keyword not in stats['keyword_matches']:
-                        stats['keyword_matches'][keyword] = []
-                    stats['keyword_matches'][keyword].append({
-                        'line_num': i + 1,
-                        'function': function['name']
-                    })
-                    break
+    for function in structure['functions']:
+        for i in claims.get(function['id'], ()):
+            comment_hit(i).append({
+                'line_num': i + 1,
+                'function': function['name']
+            })
+            function['lines_commented'].append(i)
         
-        if function_modified:
+        if function['lines_commented']:
             stats['modified_functions'].add(function['name'])
     
     # Process loops
-    for loop in loops:
-        loop_modified = False
-        
-        for i in range(loop['start'] + 1, loop['end']):
-            if orig_commented[i]:
-                continue
-            
-            # Skip loop terminators and non-meaningful lines
-            line_content = lines[i].strip()
-            if (line_content in ['done', 'esac', ';;'] or
-                line_content.endswith(')') and not line_content.startswith('stamp') or
-                line_content.startswith('#') or
-                not line_content):
-                continue
-                
-            for keyword in keywords:
-                if keyword in new_lines[i]:
-                    new_lines[i] = comment_line(new_lines[i])
-                    loop['lines_commented'].append(i)
-                    loop_modified = True
-                    stats['lines_modified'] += 1
-                    
-                    if keyword not in stats['keyword_matches']:
-                        stats['keyword_matches'][keyword] = []
-                    stats['keyword_matches'][keyword].append({
-                        'line_num': i + 1,
-                        'loop': f"{loop['type']} loop at line {loop['start'] + 1}"
-                    })
-                    break
+    for loop in structure['loops']:
+        for i in claims.get(loop['id'], ()):
+            comment_hit(i).append({
+                'line_num': i + 1,
+                'loop': f"{loop['type']} loop at line {loop['start'] + 1}"
+            })
+            loop['lines_commented'].append(i)
         
-        if loop_modified:
+        if loop['lines_commented']:
             stats['modified_loops'].add(f"{loop['type']}_line_{loop['start'] + 1}")
     
     return new_lines, stats
 
-def check_fully_commented_structures(lines, sections, functions, loops, keywords):
-    """Check and handle fully commented sections, functions, and loops with sophisticated logic."""
+# Whether a line counts as content of a block, per block kind; stamp lines
+# are section structure, and loops only count their keyword lines
+_BLOCK_CONTENT_TESTS = {
+    'subsection': lambda info: info.kind != 'blank',
+    'section': lambda info: info.kind != 'blank' and not info.stamp,
+    'function': lambda info: not (info.kind in ('blank', 'brace') or info.content in ("return 0", "return")
+                                  or info.stamp),
+    'loop': lambda info: info.kind not in ('blank', 'comment', 'done', 'esac', 'case_end', 'case_pattern'),
+}
+
+class _WorkNode:
+    """Fully-commented check state of one block: the next line to examine
+    (`cursor`) up to `last`, whether a content line was seen, and whether the
+    block is resolved or queued."""
+    __slots__ = ('kind', 'block', 'cursor', 'last', 'has_content', 'resolved', 'queued')
+
+    def __init__(self, kind, block, first, last):
+        self.kind = kind
+        self.block = block
+        self.cursor = first
+        self.last = last
+        self.has_content = False
+        self.resolved = False
+        self.queued = True
+
+def _structure_nodes(sections, functions, loops):
+    """Return worklist nodes for every block, in the order they are first examined.
+
+    That is each section's subsections, then the section, then functions,
+    then loops.
+    """
+    nodes = []
+    for section in sections:
+        for subsection in section['subsections']:
+            nodes.append(_WorkNode('subsection', subsection, subsection['start'] + 1, subsection['end']))
+        nodes.append(_WorkNode('section', section, section['start'] + 1, section['end'] - 1))
+    for function in functions:
+        nodes.append(_WorkNode('function', function, function['start'] + 1, function['end']))
+    for loop in loops:
+        nodes.append(_WorkNode('loop', loop, loop['start'] + 1, loop['end'] - 1))
+    return nodes
+
+def _block_fully_commented(node, meta, hit_lines, watchers):
+    """Return True once every content line of the node's block is commented.
+
+    `hit_lines` is the sorted list of lines with keyword hits. Lines only
+    ever become commented, and a commented or blank line never changes
+    again, so the scan resumes where the previous examination of this block
+    stopped. When it returns False the node is added to `watchers` under
+    the uncommented content line it stopped at, and under the stamp or
+    brace lines that would give it content once an enclosing block
+    comments them; only commenting one of those lines can change the answer.
+    """
+    counts = _BLOCK_CONTENT_TESTS[node.kind]
+    first, last = node.cursor, node.last
+    if node.kind == 'loop':
+        lo, hi = bisect.bisect_left(hit_lines, first), bisect.bisect_right(hit_lines, last)
+        candidates = (hit_lines[k] for k in range(lo, hi))
+    else:
+        candidates = range(first, last + 1)
+    has_content = node.has_content
+    for i in candidates:
+        info = meta[i]
+        if counts(info):
+            if not info.commented:
+                node.cursor = i
+                node.has_content = has_content
+                watchers[i].append(node)
+                return False
+            has_content = True
+        # Commenting a loop line never makes it count
+        elif not (has_content or info.commented or info.kind == 'blank' or node.kind == 'loop'):
+            watchers[i].append(node)
+    node.cursor = last + 1
+    node.has_content = has_content
+    return has_content
+
+def check_fully_commented_structures(lines, sections, functions, loops, hits, meta=None, messages=None):
+    """Check and handle fully commented sections, functions, and loops with sophisticated logic.
+
+    Every block is examined once, then again only when a line it is
+    waiting on gets commented, so the result is a fixpoint however deep
+    the nesting and each block's lines are scanned about once. Loop keyword lines are looked up in
+    `hits`, the HitIndex from the first scan. Progress messages are appended
+    to the `messages` list when given, and printed otherwise.
+    """
+    if meta is None:
+        meta = build_line_meta(lines)
+    say = print if messages is None else messages.append
     fully_comented_sections = set()
     fully_comented_functions = set()
     fully_comented_loops = set()
     fully_comented_subsections = set()  # NEW: Track fully commented subsections
 
-    # Check sections - more sophisticated logic
-    for section in sections:
-        # Check subsections
-        for subsection in section['subsections']:
-            all_content_commented = True
-            has_content = False
-            for i in range(subsection['start'] + 1, subsection['end'] + 1):
-                line = lines[i]
-                line_content = line.strip()
-                if line_content == "":
-                    continue
-                if not line.lstrip().startswith("#"):
-                    all_content_commented = False
-                    break
-                has_content = True
-            if has_content and all_content_commented:
-                fully_comented_subsections.add(subsection['start'])
-                # Comment the stamp line if not already commented
-                if not lines[subsection['start']].lstrip().startswith("#"):
-                    lines[subsection['start']] = comment_line(lines[subsection['start']])
-
-        # Check if all non-empty, non-stamp content lines are commented
-        all_content_commented = True
-        has_content = False
-        
-        for i in range(section['start'] + 1, section['end']):
-            line = lines[i]
-            line_content = line.strip()
-            
-            # Skip empty lines
-            if line_content == "":
-                continue
-                
-            # Skip stamp lines (they are section structure, not content)
-            if re.match(r'^\s*stamp\s+"', line, re.IGNORECASE):
-                continue
-            
-            has_content = True
-            
-            # If this line is not commented, section is not fully commented
-            if not line.lstrip().startswith("#"):
-                all_content_commented = False
-                break
-        
-        # If section has content and all content is commented, comment the whole section
-        if has_content and all_content_commented:
-            fully_comented_sections.add(section['num'])
-            print(f"Section {section['num']} is fully commented - commenting header/footer")
-            
+    hit_lines = sorted(hits.hits)
+    worklist = collections.deque(_structure_nodes(sections, functions, loops))
+    watchers = collections.defaultdict(list)
+
+    def comment(i):
+        comment_at(lines, meta, i)
+        # Only blocks waiting on this line can change status
+        for other in watchers.pop(i, ()):
+            if i < other.cursor and _BLOCK_CONTENT_TESTS[other.kind](meta[i]):
+                other.has_content = True
+            if not other.resolved and not other.queued:
+                other.queued = True
+                worklist.append(other)
+
+    while worklist:
+        node = worklist.popleft()
+        node.queued = False
+        if node.resolved or not _block_fully_commented(node, meta, hit_lines, watchers):
+            continue
+        node.resolved = True
+        kind, block = node.kind, node.block
+
+        if kind == 'subsection':
+            fully_comented_subsections.add(block['start'])
+            # Comment the stamp line if not already commented
+            if not meta[block['start']].commented:
+                comment(block['start'])
+
+        elif kind == 'section':
+            fully_comented_sections.add(block['num'])
+            say(f"Section {block['num']} is fully commented - commenting header/footer")
+
             # Comment header and footer
-            if not lines[section['start']].lstrip().startswith("#"):
-                lines[section['start']] = comment_line(lines[section['start']])
-            if not lines[section['end']].lstrip().startswith("#"):
-                lines[section['end']] = comment_line(lines[section['end']])
-                
+            if not meta[block['start']].commented:
+                comment(block['start'])
+            if not meta[block['end']].commented:
+                comment(block['end'])
+
             # Also comment all stamp lines in this section
-            for subsection in section['subsections']:
-                if not lines[subsection['start']].lstrip().startswith("#"):
-                    lines[subsection['start']] = comment_line(lines[subsection['start']])    # Check functions - more sophisticated logic
-    for function in functions:
-        all_meaningful_content_commented = True
-        has_meaningful_content = False
-        
-        for i in range(function['start'] + 1, function['end'] + 1):
-            line = lines[i]
-            line_content = line.strip()
-            
-            # Skip empty lines, closing braces, simple return statements, and stamp commands
-            if (line_content == "" or 
-                line_content == "}" or 
-                line_content == "return 0" or 
-                line_content == "return" or
-                re.match(r'^\s*stamp\s+"', line, re.IGNORECASE)):
-                continue
-                
-            has_meaningful_content = True
-            
-            # If this meaningful content line is not commented, function is not fully commented
-            if not line.lstrip().startswith("#"):
-                all_meaningful_content_commented = False
-                break
-        
-        # If function has meaningful content and all meaningful content is commented, comment the whole function
-        if has_meaningful_content and all_meaningful_content_commented:
-            fully_comented_functions.add(function['name'])
-            print(f"Function {function['name']} is fully commented - commenting declaration and all content")
-            
+            for subsection in block['subsections']:
+                if not meta[subsection['start']].commented:
+                    comment(subsection['start'])
+
+        elif kind == 'function':
+            fully_comented_functions.add(block['name'])
+            say(f"Function {block['name']} is fully commented - commenting declaration and all content")
+
             # Comment function declaration
-            if not lines[function['start']].lstrip().startswith("#"):
-                lines[function['start']] = comment_line(lines[function['start']])
-            
+            if not meta[block['start']].commented:
+                comment(block['start'])
+
             # Comment all lines within the function (including stamps)
-            for i in range(function['start'] + 1, function['end']):
-                if not lines[i].lstrip().startswith("#") and lines[i].strip():
-                    lines[i] = comment_line(lines[i])
-              # Comment closing brace if it exists
-            if (function['end'] < len(lines) and 
-                lines[function['end']].strip() == "}" and
-                not lines[function['end']].lstrip().startswith("#")):
-                lines[function['end']] = comment_line(lines[function['end']])    # Check loops for full commenting
-    for loop in loops:
-        has_keyword_content = False
-        all_keyword_content_commented = True
-        
-        for i in range(loop['start'] + 1, loop['end']):
-            line = lines[i]
-            line_content = line.strip()
-            
-            # Skip empty lines and comments
-            if (line_content == "" or line.lstrip().startswith("#")):
-                continue
-            
-            # Skip loop structural elements
-            if (line_content in ['done', 'esac', ';;'] or
-                re.match(r'^\s*\w+.*\)\s*$', line_content) or  # case patterns  
-                re.match(r'^\s*\*\)\s*$', line_content)):
-                continue
-            
-            # Check if this line contains any keywords
-            contains_keywords = any(keyword in line for keyword in keywords)
-            
-            if contains_keywords:
-                has_keyword_content = True
-                # If this keyword line is not commented, loop is not fully commented
-                if not line.lstrip().startswith("#"):
-                    all_keyword_content_commented = False
-                    break
-        
-        # If loop has keyword content and all keyword content is commented, comment the whole loop
-        if has_keyword_content and all_keyword_content_commented:
-            fully_comented_loops.add(f"{loop['type']}_line_{loop['start'] + 1}")
-            print(f"Loop {loop['type']} at line {loop['start'] + 1} is fully commented - commenting entire loop structure")
-            
+            for i in range(block['start'] + 1, block['end']):
+                if not meta[i].commented and meta[i].kind != 'blank':
+                    comment(i)
+            # Comment closing brace if it exists
+            if block['end'] < len(lines) and meta[block['end']].kind == 'brace':
+                comment(block['end'])
+
+        else:
+            fully_comented_loops.add(f"{block['type']}_line_{block['start'] + 1}")
+            say(f"Loop {block['type']} at line {block['start'] + 1} is fully commented - commenting entire loop structure")
+
             # Comment loop start
-            if not lines[loop['start']].lstrip().startswith("#"):
-                lines[loop['start']] = comment_line(lines[loop['start']])
-            
+            if not meta[block['start']].commented:
+                comment(block['start'])
+
             # Comment all lines within the loop
-            for i in range(loop['start'] + 1, loop['end']):
-                if not lines[i].lstrip().startswith("#") and lines[i].strip():
-                    lines[i] = comment_line(lines[i])
-            
+            for i in range(block['start'] + 1, block['end']):
+                if not meta[i].commented and meta[i].kind != 'blank':
+                    comment(i)
+
             # Comment loop end
-            if (loop['end'] < len(lines) and 
-                not lines[loop['end']].lstrip().startswith("#")):
-                lines[loop['end']] = comment_line(lines[loop['end']])
-    
+            if block['end'] < len(lines) and not meta[block['end']].commented:
+                comment(block['end'])
+
     return fully_comented_sections, fully_comented_functions, fully_comented_loops, fully_comented_subsections
 
-def renumber_sections(lines, sections, fully_comented_sections, fully_comented_subsections=None):
-    """Renumber only active (non-fully-commented) sections and their stamp commands."""
+# Pattern: stamp "Section X(.Y)?: description", commented or not
+STAMP_COMMAND_PATTERN = re.compile(r'^(\s*#?\s*stamp\s+"[^"]*Section\s+)(\d+)(?:\.(\d+))?(:[^\"]*")', re.IGNORECASE)
+
+def renumber_sections(lines, sections, fully_comented_sections, fully_comented_subsections=None, meta=None,
+                      stamp_lines=None):
+    """Renumber only active (non-fully-commented) sections and their stamp commands.
+
+    `stamp_lines` is the sorted list of lines STAMP_COMMAND_PATTERN matches.
+    Commenting a line does not change whether it matches, so the list can be
+    found once per script; by default it is found here.
+    """
+    if meta is None:
+        meta = build_line_meta(lines)
+    if stamp_lines is None:
+        stamp_lines = [i for i, line in enumerate(lines) if STAMP_COMMAND_PATTERN.match(line)]
     if fully_comented_subsections is None:
         fully_comented_subsections = set()
     active_sections = [s for s in sections if s['num'] not in fully_comented_sections]
@@ -593,54 +1448,208 @@ def renumber_sections(lines, sections, fully_comented_sections, fully_comented_s
             header_line,
             flags=re.IGNORECASE
         )
-        lines[section['start']] = updated_header
+        if updated_header != header_line:
+            set_line(lines, meta, section['start'], updated_header)
         
         # Update stamp commands within this section to use the new section numbering, skipping fully commented subsections
-        update_stamp_commands_in_section(lines, section, new_num, fully_comented_subsections)
+        update_stamp_commands_in_section(lines, section, new_num, fully_comented_subsections, meta, stamp_lines)
     
     return renumber_map
 
-def update_stamp_commands_in_section(lines, section, new_section_num, fully_comented_subsections=None):
-    """Update stamp commands within a section to use the new section numbering, skipping fully commented subsections."""
+def update_stamp_commands_in_section(lines, section, new_section_num, fully_comented_subsections=None, meta=None,
+                                     stamp_lines=None):
+    """Update stamp commands within a section to use the new section numbering, skipping fully commented subsections.
+
+    With `stamp_lines` (see renumber_sections) only those lines are checked.
+    """
+    if meta is None:
+        meta = build_line_meta(lines)
     if fully_comented_subsections is None:
         fully_comented_subsections = set()
-    # Pattern: stamp "Section X(.Y)?: description"
-    stamp_pattern = re.compile(r'^(\s*#?\s*stamp\s+"[^"]*Section\s+)(\d+)(?:\.(\d+))?(:[^\"]*")', re.IGNORECASE)
+    if stamp_lines is None:
+        candidates = range(section['start'], section['end'] + 1)
+    else:
+        candidates = stamp_lines[bisect.bisect_left(stamp_lines, section['start']):
+                                 bisect.bisect_right(stamp_lines, section['end'])]
     subsection_counter = 1
-    for i in range(section['start'], section['end'] + 1):
+    for i in candidates:
         if i in fully_comented_subsections:
             continue  # Skip fully commented subsections
         line = lines[i]
-        match = stamp_pattern.match(line)
+        match = STAMP_COMMAND_PATTERN.match(line)
         if match:
             old_section_num = int(match.group(2))
             if old_section_num == section['num']:
                 rest_of_line = line[match.end():]
                 # Always use Section X.Y: ...
                 updated_line = f"{match.group(1)}{new_section_num}.{subsection_counter}{match.group(4)}{rest_of_line}"
-                lines[i] = updated_line
+                if updated_line != line:
+                    set_line(lines, meta, i, updated_line)
                 subsection_counter += 1
                 continue
 
-def apply_global_replacements(lines):
-    """Apply global text replacements."""
-    replacement_count = 0
-    patterns = ["_bdi_", "_bdi", "bdi_", "bdi"]
-    target = "war"
-    
-    for i, line in enumerate(lines):
-        original = line
-        for pattern in patterns:
-            if pattern in line:
-                lines[i] = lines[i].replace(pattern, target)
-        if lines[i] != original:
-            replacement_count += 1
-    
-    return replacement_count
+class ReplacementRules:
+    """Global replacement rules applied in one left-to-right pass per line.
+
+    Each rule is a dict with 'kind' ('literal', 'word' or 'regex'), 'pattern'
+    and 'replacement'. Literal and word rules become named alternatives of a
+    single pattern; regex rules are compiled on their own so their groups and
+    backreferences keep their meaning. At a given position the first listed
+    rule that matches wins. Regex replacements may use group references such
+    as \\1. Rules that match the empty string are rejected.
+    """
+
+    def __init__(self, rules):
+        self.rules = list(rules)
+        alternatives = []
+        self._regexes = []
+        for idx, rule in enumerate(self.rules):
+            if rule['kind'] == 'regex':
+                compiled = re.compile(rule['pattern'])
+                if compiled.match(""):
+                    raise ValueError(f"rule /{rule['pattern']}/ matches an empty string")
+                self._regexes.append((compiled, idx))
+                continue
+            if not rule['pattern']:
+                raise ValueError(f"{rule['kind']} rule has an empty pattern")
+            if rule['kind'] == 'word':
+                source = rf"\b{re.escape(rule['pattern'])}\b"
+            else:
+                source = re.escape(rule['pattern'])
+            alternatives.append(f"(?P<r{idx}>{source})")
+        self._pattern = re.compile("|".join(alternatives)) if alternatives else None
+        # Each match source: a regex rule with its index, or the combined pattern (index None)
+        self._sources = ([(self._pattern, None)] if self._pattern is not None else []) + self._regexes
+        # Only literal and word rules keep their meaning when searched in raw bytes
+        self._bytes_pattern = None
+        if self._pattern is not None and not self._regexes:
+            self._bytes_pattern = re.compile("|".join(alternatives).encode("utf-8"))
+
+    @staticmethod
+    def label(rule):
+        """Human-readable form of a rule's pattern for the changelog."""
+        if rule['kind'] == 'regex':
+            return f"/{rule['pattern']}/"
+        if rule['kind'] == 'word':
+            return f"word '{rule['pattern']}'"
+        return f"'{rule['pattern']}'"
+
+    def fingerprint(self):
+        """Stable text form of the rules, for cache keys."""
+        return "\n".join(f"{r['kind']}\0{r['pattern']}\0{r['replacement']}" for r in self.rules)
+
+    def search_bytes(self, data):
+        """Return whether any rule may match the UTF-8 bytes `data`.
+
+        Rule sets with regex rules cannot be checked on bytes and always
+        report True.
+        """
+        if not self._sources:
+            return False
+        if self._bytes_pattern is None:
+            return True
+        return self._bytes_pattern.search(data) is not None
+
+    @staticmethod
+    def _search(source, line, pos):
+        """Return (start, rule index, match) for the next non-empty match of `source` from `pos`, or None."""
+        pattern, idx = source
+        while pos <= len(line):
+            match = pattern.search(line, pos)
+            if match is None:
+                return None
+            if match.end() > match.start():
+                return match.start(), int(match.lastgroup[1:]) if idx is None else idx, match
+            pos = match.start() + 1
+        return None
+
+    def _sub(self, line, counts):
+        """Replace every rule match in `line`, scanning once from left to right."""
+        sources = self._sources
+        found = [self._search(source, line, 0) for source in sources]
+        pieces = []
+        pos = 0
+        while True:
+            best = min((hit for hit in found if hit is not None), key=lambda hit: hit[:2], default=None)
+            if best is None:
+                break
+            start, idx, match = best
+            rule = self.rules[idx]
+            pieces.append(line[pos:start])
+            pieces.append(match.expand(rule['replacement']) if rule['kind'] == 'regex' else rule['replacement'])
+            counts[idx] += 1
+            pos = match.end()
+            # A later match found from an earlier position is still the next one
+            found = [hit if hit is None or hit[0] >= pos else self._search(source, line, pos)
+                     for source, hit in zip(sources, found)]
+        if not pieces:
+            return line
+        pieces.append(line[pos:])
+        return "".join(pieces)
+
+    def _line_sub(self, counts):
+        """Return a function replacing every rule match in one line, adding the occurrences to `counts`."""
+        if self._regexes:
+            return lambda line: self._sub(line, counts)
+        rules = self.rules
+        
+        def dispatch(match):
+            idx = int(match.lastgroup[1:])
+            counts[idx] += 1
+            return rules[idx]['replacement']
+        
+        # Without regex rules the combined pattern alone finds every match
+        return lambda line: self._pattern.sub(dispatch, line)
+
+    def apply(self, lines, meta=None):
+        """Rewrite `lines` in place; return (lines changed, occurrences per rule index)."""
+        counts = [0] * len(self.rules)
+        if not self._sources:
+            return 0, counts
+        sub = self._line_sub(counts)
+        changed = 0
+        for i, line in enumerate(lines):
+            updated = sub(line)
+            if updated != line:
+                lines[i] = updated
+                if meta is not None:
+                    meta[i] = LineInfo(updated)
+                changed += 1
+        return changed, counts
+
+# The historical rename: every 'bdi' variant becomes 'war'
+DEFAULT_REPLACEMENT_RULES = ReplacementRules(
+    {'kind': 'literal', 'pattern': pattern, 'replacement': "war"}
+    for pattern in ["_bdi_", "_bdi", "bdi_", "bdi"]
+)
+
+def apply_global_replacements(lines, meta=None, rules=None):
+    """Apply global text replacements.
+
+    `rules` is a ReplacementRules (default: the 'bdi' → 'war' rules). Returns
+    the number of lines changed and a {rule label: occurrences} dict for the
+    rules that matched.
+    """
+    rules = rules or DEFAULT_REPLACEMENT_RULES
+    replacement_count, counts = rules.apply(lines, meta)
+    return replacement_count, _rule_counts(rules, counts)
+
+def _rule_counts(rules, counts):
+    """Turn occurrences per rule index into the {rule label: occurrences} dict of the changelog."""
+    rule_counts = {}
+    for rule, count in zip(rules.rules, counts):
+        if count:
+            key = f"{rules.label(rule)} → '{rule['replacement']}'"
+            rule_counts[key] = rule_counts.get(key, 0) + count
+    return rule_counts
 
 def generate_changelog(stats, sections, functions, fully_comented_sections, 
-                      fully_comented_functions, renumber_map, global_replacements):
-    """Generate detailed changelog."""
+                      fully_comented_functions, renumber_map, global_replacements, replacement_counts=None):
+    """Generate detailed changelog.
+
+    `replacement_counts` maps each global replacement rule that matched to its
+    number of occurrences.
+    """
     changelog = []
     changelog.append("# ** CHANGELOG SUMMARY")
     changelog.append(f"# Generated on: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
@@ -707,52 +1716,64 @@ def generate_changelog(stats, sections, functions, fully_comented_sections,
         if global_replacements > 0:
             changelog.append("# GLOBAL REPLACEMENTS:")
             changelog.append(f"#   • {global_replacements} lines modified")
-            changelog.append("#   • All 'bdi' variants → 'war'")
+            for rule, count in (replacement_counts or {}).items():
+                changelog.append(f"#   • {rule}: {count} occurrence{'s' if count != 1 else ''}")
             changelog.append("#")
     
     changelog.append("# END OF CHANGELOG")
     return "\n".join(changelog)
 
-def insert_changelog(lines, changelog):
-    """Insert changelog at the appropriate location - after header/docs but before script execution."""
-    marker = "# ** CHANGELOG SUMMARY below"
-    separator = "###############################################################"
-    
-    # First, try to find the explicit marker
-    marker_idx = None
-    separator_idx = None
-    
+CHANGELOG_MARKER = "# ** CHANGELOG SUMMARY below"
+CHANGELOG_SEPARATOR = "###############################################################"
+
+def changelog_markers(lines):
+    """Return the sorted indices of the lines holding CHANGELOG_MARKER, and of the other lines holding CHANGELOG_SEPARATOR."""
+    marker_lines = []
+    separator_lines = []
     for i, line in enumerate(lines):
-        if marker in line:
-            marker_idx = i
-        elif marker_idx is not None and separator in line:
-            separator_idx = i
-            break
+        if CHANGELOG_MARKER in line:
+            marker_lines.append(i)
+        elif CHANGELOG_SEPARATOR in line:
+            separator_lines.append(i)
+    return marker_lines, separator_lines
+
+def changelog_splice(lines, changelog, markers=None, messages=None):
+    """Return (start, stop, block): insert_changelog replaces lines[start:stop] with `block`.
+
+    `markers` is changelog_markers(lines), when already known. A warning is
+    appended to the `messages` list when given, and printed otherwise.
+    """
+    marker_lines, separator_lines = markers if markers is not None else changelog_markers(lines)
+    block = ["\n"] + [f"{line}\n" for line in changelog.split("\n")] + ["\n"]
     
-    if marker_idx is not None and separator_idx is not None:
-        # Insert between marker and separator
-        result = lines[:marker_idx + 1]
-        result.append("\n")
-        result.extend([f"{line}\n" for line in changelog.split("\n")])
-        result.append("\n")
-        result.extend(lines[separator_idx:])
-        return result
+    # First, try the explicit marker: insert between it and the next separator
+    for separator_idx in separator_lines:
+        k = bisect.bisect_left(marker_lines, separator_idx)
+        if k:
+            return marker_lines[k - 1] + 1, separator_idx, block
     
     # If no explicit marker found, find the smart insertion point
     insertion_point = find_smart_insertion_point(lines)
-    
     if insertion_point is not None:
-        result = lines[:insertion_point]
-        result.append("\n")
-        result.extend([f"{line}\n" for line in changelog.split("\n")])
-        result.append("\n")
-        result.extend(lines[insertion_point:])
-        return result
-    else:
-        # Fallback: append to end
-        print("Warning: Could not find appropriate insertion point. Appending to end.")
-        lines.append(f"\n{changelog}\n")
-        return lines
+        return insertion_point, insertion_point, block
+    
+    # Fallback: append to end
+    (print if messages is None else messages.append)(
+        "Warning: Could not find appropriate insertion point. Appending to end.")
+    return len(lines), len(lines), [f"\n{changelog}\n"]
+
+def insert_changelog(lines, changelog, meta=None, messages=None):
+    """Insert changelog at the appropriate location - after header/docs but before script execution.
+
+    `lines` is spliced in place and returned. If `meta` is given it is spliced
+    the same way to stay parallel to the result. `messages` is passed on to
+    changelog_splice.
+    """
+    start, stop, block = changelog_splice(lines, changelog, messages=messages)
+    lines[start:stop] = block
+    if meta is not None:
+        meta[start:stop] = build_line_meta(block)
+    return lines
 
 def find_smart_insertion_point(lines):
     """Find the appropriate insertion point after documentation but before script execution."""
@@ -828,162 +1849,539 @@ def find_smart_insertion_point(lines):
       # Fallback: insert after line 10 if nothing else works
     return min(10, len(lines) - 1)
 
-def fix_indentation(lines):
+def fix_indentation(lines, meta=None, regions=None):
     """Fix indentation for lines inside if/fi blocks and function blocks."""
-    fixed_lines = []
-    block_stack = []  # Stack to track block types and indentation
+    return list(iter_fixed_indentation(lines, meta, regions))
+
+def iter_fixed_indentation(lines, meta=None, regions=None):
+    """Yield the re-indented lines one at a time, for streaming straight to a file.
+
+    With `regions` (see reindent_regions; `lines` must then be an EditJournal)
+    only those spans are re-indented and every other line passes through as is.
+    """
+    pairs = (_fixed_indentation_pairs(lines, meta) if regions is None
+             else _region_indentation_pairs(lines, meta, regions))
+    for _, line in pairs:
+        yield line
+
+# Stages whose edits mark a block for re-indentation in region mode
+REINDENT_STAGES = ('keyword_matching', 'case_branches', 'fully_commented', 'renumber')
+REINDENT_BLOCK_KINDS = ('section', 'function', 'loop', 'case')
+
+def reindent_regions(journal, index, stages=REINDENT_STAGES):
+    """Return the sorted, merged (start, end) original-line spans to re-indent.
+
+    Each line changed by one of `stages` contributes its innermost enclosing
+    section, function, loop or case, or just itself outside any block.
+    """
+    spans = []
+    for i in journal.touched(stages):
+        block = next((node for node in index.enclosing(i) if node['kind'] in REINDENT_BLOCK_KINDS), None)
+        spans.append((block['start'], block['end']) if block else (i, i))
+    spans.sort()
+    regions = []
+    for start, end in spans:
+        if regions and start <= regions[-1][1]:
+            regions[-1] = (regions[-1][0], max(regions[-1][1], end))
+        else:
+            regions.append((start, end))
+    return regions
+
+def _region_indentation_pairs(journal, meta, regions):
+    """Like _fixed_indentation_pairs, but only for lines inside `regions`.
+
+    Each region is re-indented on its own, starting from an empty block
+    stack; lines outside the regions, and inserted lines, are yielded as is.
+    """
+    chunk = []  # (output index, line) of the region being collected
+    r = 0
     
-    for i, line in enumerate(lines):
-        stripped = line.strip()
-        
-        # Skip empty lines
-        if not stripped:
-            fixed_lines.append(line)
+    def flush():
+        sub_meta = [meta[j] for j, _ in chunk]
+        for k, line in _fixed_indentation_pairs([line for _, line in chunk], sub_meta):
+            yield chunk[k][0], line
+        chunk.clear()
+    
+    j = -1
+    for src, text in journal.iter_origins():
+        if text is None:
             continue
-        
-        # Get original indentation
-        indent_match = re.match(r'^(\s*)', line)
-        original_indent = indent_match.group(1) if indent_match else ""
-        
-        # Fix lines that have multiple commands separated by excessive spaces
-        # Look for pattern like: command1 >> file        command2
-        if re.search(r'\S\s{6,}\S', line) and not stripped.startswith("#"):
-            # Split on 6+ spaces and treat as separate lines
-            parts = re.split(r'\s{6,}', line.strip())
-            if len(parts) > 1:
-                # First part
-                if block_stack:
-                    base_indent = block_stack[-1]['indent']
-                    fixed_lines.append(f"{base_indent}    {parts[0]}\n")
-                else:
-                    fixed_lines.append(f"{original_indent}{parts[0]}\n")
-                
-                # Remaining parts
-                for part in parts[1:]:
-                    if part.strip():
-                        if block_stack:
-                            base_indent = block_stack[-1]['indent']
-                            fixed_lines.append(f"{base_indent}    {part.strip()}\n")
-                        else:
-                            fixed_lines.append(f"{original_indent}{part.strip()}\n")
-                continue
-        
-        # Comments - preserve as-is but adjust indentation if inside blocks
-        if stripped.startswith("#"):
-            if block_stack:
-                # Inside a block - indent comments to match block level
-                base_indent = block_stack[-1]['indent']
-                content = line.lstrip()
-                fixed_lines.append(f"{base_indent}    {content}")
-            else:
-                fixed_lines.append(line)
-            continue        # Check for block starters
-        if (re.match(r'^\s*if\s+', stripped) or 
-            re.match(r'^\s*function\s+', stripped) or
-            re.match(r'^\s*case\s+', stripped) or
-            re.match(r'^\s*select\s+', stripped)):
-            
-            # This line starts a new block
-            block_type = 'if'
-            if stripped.startswith('function'):
-                block_type = 'function'
-            elif stripped.startswith('case'):
-                block_type = 'case'
-            elif stripped.startswith('for'):
-                block_type = 'for'
-            elif stripped.startswith('while'):
-                block_type = 'while'
-            elif stripped.startswith('until'):
-                block_type = 'until'
-            elif stripped.startswith('select'):
-                block_type = 'select'
-                
-            block_stack.append({
-                'type': block_type,
-                'indent': original_indent
-            })
-            fixed_lines.append(line)  # Keep block starter line as-is
+        j += 1
+        inside = False
+        if src is not None:
+            while r < len(regions) and regions[r][1] < src:
+                r += 1
+            inside = r < len(regions) and regions[r][0] <= src
+            # A new region starts its own block stack
+            if inside and chunk and src == regions[r][0]:
+                yield from flush()
+        if inside:
+            chunk.append((j, text))
             continue
-        
-        # Check for block enders
-        if (stripped == "fi" or stripped == "}" or stripped == "esac" or 
-            stripped == "done"):
-            # This line ends a block
-            if block_stack:
-                block_info = block_stack.pop()
-                # Use the same indentation as the opening statement
-                content = line.lstrip()
-                fixed_lines.append(f"{block_info['indent']}{content}")
-            else:
-                fixed_lines.append(line)
+        if chunk:
+            yield from flush()
+        yield j, text
+    if chunk:
+        yield from flush()
+
+# Leading words that open an indentation block, and the block type they push
+INDENT_BLOCK_STARTERS = {'if': 'if', 'function': 'function', 'case': 'case', 'select': 'select'}
+INDENT_BLOCK_ENDERS = frozenset(('fi', 'brace', 'esac', 'done'))
+WIDE_GAP_PATTERN = re.compile(r'\s{6,}')
+
+def _fixed_indentation_pairs(lines, meta=None):
+    """Yield (input index, output line); a line split on wide gaps yields several.
+
+    One forward pass over the lines with _indent_step.
+    """
+    if meta is None:
+        meta = build_line_meta(lines)
+    stack = None
+    for i, line in enumerate(lines):
+        outputs, stack = _indent_step(stack, line, meta[i])
+        for output in outputs:
+            yield i, output
+
+def _indent_step(stack, line, info):
+    """Re-indent one line; return (its output lines, the open blocks after it).
+
+    `stack` holds the open blocks before the line: None, or (top, rest)
+    where top is the (block type, indent) of the innermost one. Stacks are
+    never modified, so one can be kept and the pass resumed from it. Each
+    line is classified from its LineInfo kind and leading word and handled in
+    constant time apart from splitting it on wide gaps.
+    """
+    kind = info.kind
+    
+    # Skip empty lines
+    if kind == 'blank':
+        return (line,), stack
+    
+    start = info.start
+    top = stack[0] if stack else None
+    
+    # Comments - preserve as-is but adjust indentation if inside blocks
+    if kind == 'comment':
+        return (f"{top[1]}    {line[start:]}" if top else line,), stack
+    
+    # Lines holding several commands separated by 6+ spaces are split,
+    # e.g. command1 >> file        command2
+    if WIDE_GAP_PATTERN.search(line, start, len(line) - info.tail):
+        stripped = info.content
+        base_indent = top[1] + "    " if top else line[:start]
+        parts = WIDE_GAP_PATTERN.split(stripped)
+        outputs = [f"{base_indent}{parts[0]}\n"]
+        outputs.extend(f"{base_indent}{part.strip()}\n" for part in parts[1:] if part.strip())
+        return outputs, stack
+    
+    # Block starters (if/function/case/select followed by more words) are kept as-is
+    head = line.split(None, 1)
+    if len(head) == 2 and head[0] in INDENT_BLOCK_STARTERS:
+        return (line,), ((INDENT_BLOCK_STARTERS[head[0]], line[:start]), stack)
+    
+    content = line[start:]
+    # Block enders take the indentation of their opening statement
+    if kind in INDENT_BLOCK_ENDERS:
+        if stack:
+            return (f"{top[1]}{content}",), stack[1]
+        return (line,), stack
+    # Case patterns and ';;' sit one level inside their case
+    if kind == 'case_pattern' or kind == 'case_end':
+        if top and top[0] == 'case':
+            return (f"{top[1]}    {content}",), stack
+        return (line,), stack
+    # Content of a case pattern is indented twice, other block content once
+    if top:
+        if top[0] == 'case' and not line.startswith('case', start):
+            return (f"{top[1]}        {content}",), stack
+        return (f"{top[1]}    {content}",), stack
+    return (line,), stack
+
+def _patch_range(start, length):
+    """Format a unified-diff hunk range the way difflib does."""
+    if length == 1:
+        return f"{start + 1}"
+    if not length:
+        start -= 1
+    return f"{start + 1},{length}"
+
+def _journal_ops(journal, meta, regions=None):
+    """Yield (tag, text) diff operations between journal.base and the final output.
+
+    Original lines are paired with what the re-indentation pass made of them,
+    so unchanged lines are recognised without diffing the two files. Runs of
+    changes are yielded as all removals followed by all additions.
+    """
+    base = journal.base
+    # Without meta the output is the journal itself, with no re-indentation
+    if meta is None:
+        pairs = enumerate(journal)
+    elif regions is None:
+        pairs = _fixed_indentation_pairs(journal, meta)
+    else:
+        pairs = _region_indentation_pairs(journal, meta, regions)
+    groups = itertools.groupby(pairs, key=lambda pair: pair[0])
+    removed, added = [], []
+    for src, text in journal.iter_origins():
+        if text is None:
+            removed.append(base[src])
             continue
-        
-        # Special handling for case patterns (lines ending with ) or ;;)
-        if (re.match(r'^\s*\w+.*\)\s*$', stripped) or 
-            re.match(r'^\s*\*\)\s*$', stripped) or
-            stripped == ";;"):
-            # Case pattern or case terminator - use base case indentation + 4 spaces
-            if block_stack and block_stack[-1]['type'] == 'case':
-                base_indent = block_stack[-1]['indent']
-                content = line.lstrip()
-                fixed_lines.append(f"{base_indent}    {content}")
+        _, group = next(groups)
+        outputs = [line for _, line in group]
+        if src is not None and len(outputs) == 1 and (outputs[0] is base[src] or outputs[0] == base[src]):
+            yield from (('-', line) for line in removed)
+            yield from (('+', line) for line in added)
+            removed, added = [], []
+            yield ' ', base[src]
+        else:
+            if src is not None:
+                removed.append(base[src])
+            added.extend(outputs)
+    yield from (('-', line) for line in removed)
+    yield from (('+', line) for line in added)
+
+def iter_unified_diff(journal, meta, fromfile, tofile, context=3, regions=None):
+    """Yield a unified diff from journal.base to the processed output.
+
+    The output is the re-indented journal (only within `regions`, if given),
+    or the journal as is if `meta` is None.
+
+    Only hunks around edited lines are produced, so the amount written grows
+    with the number of edits rather than with the script size.
+    """
+    hunk = None  # [old_start, new_start, old_len, new_len, lines]
+    lead = []  # up to `context` unchanged lines before the next change
+    tail = []  # unchanged lines after the last change in the open hunk
+    old_no = new_no = 0
+    header_sent = False
+
+    def emit(hunk, closing):
+        old_start, new_start, old_len, new_len, body = hunk
+        body = body + closing
+        old_len += len(closing)
+        new_len += len(closing)
+        out = [] if header_sent else [f"--- {fromfile}\n", f"+++ {tofile}\n"]
+        out.append(f"@@ -{_patch_range(old_start, old_len)} +{_patch_range(new_start, new_len)} @@\n")
+        for tag, line in body:
+            out.append(tag + line)
+            if not line.endswith("\n"):
+                out.append("\n\\ No newline at end of file\n")
+        return out
+
+    for tag, line in _journal_ops(journal, meta, regions):
+        if tag == ' ':
+            if hunk is None:
+                lead.append((tag, line))
+                if len(lead) > context:
+                    lead.pop(0)
             else:
-                fixed_lines.append(line)
+                tail.append((tag, line))
+                if len(tail) > 2 * context:
+                    yield from emit(hunk, tail[:context])
+                    header_sent = True
+                    lead = tail[len(tail) - context:] if context else []
+                    hunk, tail = None, []
+            old_no += 1
+            new_no += 1
             continue
-          # For lines inside blocks, add extra indentation
-        if block_stack:
-            # We're inside a block, add 4 spaces to the base block indentation
-            base_indent = block_stack[-1]['indent']
-            content = line.lstrip()
-            
-            # Special handling for case statements - content inside case patterns gets double indent
-            if (block_stack[-1]['type'] == 'case' and 
-                not re.match(r'^\s*\w+.*\)\s*$', stripped) and
-                not re.match(r'^\s*\*\)\s*$', stripped) and
-                stripped != ";;" and
-                not stripped.startswith('case')):
-                # This is content inside a case pattern - double indent
-                new_indent = base_indent + "        "  # 8 spaces for case content
-            else:
-                # Regular block content - single indent
-                new_indent = base_indent + "    "  # 4 spaces
-                
-            fixed_lines.append(f"{new_indent}{content}")
+        if hunk is None:
+            hunk = [old_no - len(lead), new_no - len(lead), len(lead), len(lead), list(lead)]
+            lead = []
         else:
-            # Not inside a block, keep original line
-            fixed_lines.append(line)
-    
-    return fixed_lines
+            hunk[4].extend(tail)
+            hunk[2] += len(tail)
+            hunk[3] += len(tail)
+            tail = []
+        hunk[4].append((tag, line))
+        if tag == '-':
+            hunk[2] += 1
+            old_no += 1
+        else:
+            hunk[3] += 1
+            new_no += 1
+    if hunk is not None:
+        yield from emit(hunk, tail[:context])
 
-def process_script(script_path, keywords_path, output_path, verbose=False):
-    """Main processing function."""
-    print(f"Processing: {script_path}")
-    
-    # Load files
+class ResultCache:
+    """Persistent cache of processed outputs.
+
+    Each entry is a copy of the output file (`<key>.out`) next to a small
+    JSON summary (`<key>.json`), so storing and restoring an entry streams
+    the file instead of holding it in memory. Entries are keyed by a hash of the script bytes, the keyword list, the
+    replacement rules, any output `options` and TOOL_VERSION. Reading an
+    entry refreshes its mtime, and evict() removes the least recently used
+    entries once the directory grows past `max_bytes`.
+
+    The parsed block structure of each script is cached alongside, keyed by
+    the script bytes and TOOL_VERSION only, so a run with a new keyword list
+    still skips parsing unchanged scripts.
+    """
+
+    def __init__(self, directory, max_bytes=DEFAULT_CACHE_MAX_MB * 1024 * 1024):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def key(script_bytes, keywords, rules=None, options=""):
+        digest = hashlib.sha256()
+        digest.update(options.encode("utf-8") + b"\0")
+        digest.update(TOOL_VERSION.encode("utf-8") + b"\0")
+        digest.update("\n".join(keywords).encode("utf-8") + b"\0")
+        digest.update((rules or DEFAULT_REPLACEMENT_RULES).fingerprint().encode("utf-8") + b"\0")
+        digest.update(script_bytes)
+        return digest.hexdigest()
+
+    @staticmethod
+    def structure_key(script_bytes):
+        digest = hashlib.sha256(b"structure\0")
+        digest.update(TOOL_VERSION.encode("utf-8") + b"\0")
+        digest.update(script_bytes)
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return self.directory / f"{key}.json"
+
+    def structure(self, key, lines, meta=None, hits=None):
+        """Return parse_structure(lines, meta, hits), from the entry under the structure_key() `key` when stored.
+
+        On a miss `lines` is parsed in full, with its line `meta` when given,
+        and stored; the blocks a lazy parse with `hits` would drop are then
+        left out of the returned tree.
+        """
+        path = self.directory / f"{key}.structure"
+        try:
+            blocks = marshal.loads(path.read_bytes())
+            os.utime(path)
+            return link_structure(blocks, hits)
+        except (OSError, ValueError, EOFError, TypeError):
+            pass
+        structure = parse_structure(lines, meta)
+        tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        try:
+            tmp_path.write_bytes(marshal.dumps(plain_structure(structure)))
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"Warning: could not write cache entry: {e}")
+        return structure if hits is None else link_structure(structure, hits)
+
+    def get(self, key, output_path):
+        """Copy the cached output for `key` to `output_path` and return its summary, or None on a miss."""
+        path = self._path(key)
+        try:
+            summary = json.loads(path.read_text(encoding="utf-8"))['summary']
+            copy_file_atomic(path.with_suffix(".out"), output_path)
+            os.utime(path)
+            os.utime(path.with_suffix(".out"))
+            return summary
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def put(self, key, output_path, summary):
+        """Store a copy of the output file at `output_path` with its summary."""
+        path = self._path(key)
+        try:
+            # The summary is written last, so a readable summary always has its output
+            copy_file_atomic(output_path, path.with_suffix(".out"))
+            tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+            tmp_path.write_text(json.dumps({'summary': summary}), encoding="utf-8")
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"Warning: could not write cache entry: {e}")
+
+    def evict(self):
+        """Delete least recently used entries until the cache fits in max_bytes."""
+        entries = []
+        total = 0
+        for path in itertools.chain(self.directory.glob("*.json"), self.directory.glob("*.out"),
+                                    self.directory.glob("*.structure")):
+            try:
+                st = path.stat()
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                path.unlink()
+                total -= size
+            except OSError:
+                pass
+
+def write_lines_atomic(output_path, lines):
+    """Stream `lines` to `output_path` through a temp file renamed into place."""
+    output_path = Path(output_path)
+    tmp_path = output_path.with_name(f".{output_path.name}.{os.getpid()}.tmp")
     try:
-        lines = script_path.read_text(encoding="utf-8").splitlines(keepends=True)
-        keywords = load_keywords(keywords_path)
-        
-        if not keywords:
-            print("No keywords found!")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.writelines(lines)
+        os.replace(tmp_path, output_path)
+    except BaseException:
+        try:
+            tmp_path.unlink()
+        except OSError:
+            pass
+        raise
+
+def copy_file_atomic(source_path, output_path):
+    """Stream the file at `source_path` to `output_path` through a temp file renamed into place."""
+    output_path = Path(output_path)
+    tmp_path = output_path.with_name(f".{output_path.name}.{os.getpid()}.tmp")
+    try:
+        shutil.copyfile(source_path, tmp_path)
+        os.replace(tmp_path, output_path)
+    except BaseException:
+        try:
+            tmp_path.unlink()
+        except OSError:
+            pass
+        raise
+
+def prefilter_script(script_path, matcher, rules=DEFAULT_REPLACEMENT_RULES):
+    """Scan a script's raw bytes through mmap without decoding or splitting it.
+
+    Returns (has_keyword, has_replacement): whether any keyword occurs anywhere
+    in the file, and whether any global replacement rule may match.
+    """
+    with open(script_path, "rb") as f:
+        if not os.fstat(f.fileno()).st_size:
+            return False, False
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            return matcher.search_bytes(data), rules.search_bytes(data)
+
+def print_summary(summary):
+    print(f"\nSUMMARY:")
+    print(f"- Lines modified by keywords: {summary['lines_modified']}")
+    print(f"- Sections modified: {summary['sections_modified']}")
+    print(f"- Functions modified: {summary['functions_modified']}")
+    print(f"- Sections fully commented: {summary['sections_fully_commented']}")
+    print(f"- Functions fully commented: {summary['functions_fully_commented']}")
+    print(f"- Global replacements: {summary['global_replacements']}")
+    print(f"- Active sections renumbered: {summary['sections_renumbered']}")
+
+class _StageRecord:
+    __slots__ = ('name', 'seconds', 'lines', 'peak_bytes', 'output')
+
+    def __init__(self, name):
+        self.name = name
+        self.seconds = 0.0
+        self.lines = 0
+        self.peak_bytes = 0
+        self.output = None
+
+def _count_changed(before, after):
+    """Count lines that differ between two versions of the line list."""
+    if len(before) == len(after):
+        return sum(1 for old, new in zip(before, after) if old is not new and old != new)
+    # Lines were inserted or split: count the span between the common prefix and suffix
+    prefix = 0
+    limit = min(len(before), len(after))
+    while prefix < limit and before[prefix] == after[prefix]:
+        prefix += 1
+    suffix = 0
+    while suffix < limit - prefix and before[-1 - suffix] == after[-1 - suffix]:
+        suffix += 1
+    return max(len(before), len(after)) - prefix - suffix
+
+class StageTimer:
+    """Per-stage wall time, lines touched and peak traced memory for one run.
+
+    Use `with timer.stage(name, lines) as stage:`. When `lines` is given it is
+    snapshotted and compared with `stage.output` (or with itself, for in-place
+    stages) to count the lines the stage changed; otherwise set `stage.lines`.
+    A disabled timer skips all measurement.
+    """
+
+    def __init__(self, enabled=True, trace_memory=True):
+        self.enabled = enabled
+        self.trace_memory = enabled and trace_memory
+        self.stages = []
+
+    @contextlib.contextmanager
+    def stage(self, name, lines=None):
+        record = _StageRecord(name)
+        if not self.enabled:
+            yield record
             return
-        
-        if verbose:
-            print(f"Loaded {len(keywords)} keywords: {keywords}")
-        print(f"Processing {len(lines)} lines...")
-        
-    except Exception as e:
-        print(f"Error reading files: {e}")
-        return
+        before = list(lines) if lines is not None else None
+        if self.trace_memory and tracemalloc.is_tracing():
+            baseline = tracemalloc.get_traced_memory()[0]
+            if hasattr(tracemalloc, "reset_peak"):
+                tracemalloc.reset_peak()
+        else:
+            baseline = None
+        started = time.perf_counter()
+        yield record
+        record.seconds = time.perf_counter() - started
+        if baseline is not None:
+            record.peak_bytes = max(0, tracemalloc.get_traced_memory()[1] - baseline)
+        if before is not None:
+            record.lines = _count_changed(before, list(record.output if record.output is not None else lines))
+        record.output = None
+        self.stages.append(record)
+
+    def report(self):
+        """Return the recorded stages as a list of plain dicts."""
+        return [{'stage': r.name, 'seconds': r.seconds, 'lines': r.lines, 'peak_bytes': r.peak_bytes}
+                for r in self.stages]
+
+def print_timings(timings):
+    print(f"\nSTAGE TIMINGS:")
+    print(f"  {'stage':<22}{'seconds':>10}{'lines':>10}{'peak KiB':>12}")
+    for record in timings:
+        print(f"  {record['stage']:<22}{record['seconds']:>10.4f}{record['lines']:>10}"
+              f"{record['peak_bytes'] / 1024:>12.1f}")
+
+def transform_lines(lines, matcher, timer=None, verbose=False, report_only=False, lazy=False, rules=None,
+                    reindent='all', parse=parse_structure):
+    """Run the full processing pipeline over `lines`.
+
+    `lines` itself is left untouched: every stage records its edits in an
+    EditJournal over it, and the edited script is materialized once, by the
+    final re-indentation pass. Returns a dict with the rewritten 'lines', the
+    'journal' and its line 'meta', the keyword 'stats', the parsed 'structure', the fully
+    commented sets, the 'renumber_map', the 'global_replacements' count and
+    the per-rule 'replacement_counts' for `rules` (a ReplacementRules).
+    Each stage is measured by `timer` if given. With `lazy` (and no enabled
+    timer), 'lines' is an iterator instead of a list, so the output can be
+    streamed to a file. With `reindent='touched'` only the blocks around
+    lines changed by commenting or renumbering are re-indented; their spans
+    are returned as 'reindent_regions' (None when everything is re-indented).
+    Re-running with another matcher over
+    result['journal'].base needs no re-read of the script. Structure
+    discovery calls `parse` like parse_structure(lines, meta, hits), e.g.
+    a ResultCache.structure bound to the script's key.
+
+    With `report_only`, commenting only marks lines in the metadata table and
+    the run stops after fully-commented detection; the result then has no
+    'lines', 'renumber_map' or replacement results, and lists at most
+    REPORT_MATCH_LIMIT matches per keyword.
+    """
+    if timer is None:
+        timer = StageTimer(enabled=False)
     
-    # Mark originally commented lines
-    orig_commented = [line.lstrip().startswith("#") for line in lines]
-    new_lines = lines.copy()
-      # Find structures
-    sections = find_sections(lines)
-    functions = find_functions(lines)
-    loops = find_loops(lines)
-    cases = find_case_statements(lines)
+    # Keyword hits come first so structure discovery can be limited to them
+    with timer.stage('keyword_scan') as stage:
+        hits = HitIndex(lines, matcher)
+        stage.lines = len(lines)
+    with timer.stage('structure') as stage:
+        # Per-line metadata shared by every stage
+        meta = build_line_meta(lines)
+        meta.rewrite = not report_only
+        # Find structures; verbose runs list every block, and touched-region
+        # re-indentation picks the innermost block around each edit, so both
+        # parse eagerly
+        eager = verbose or reindent == 'touched'
+        structure = parse(lines, meta, None if eager else hits)
+        index = StructureIndex(structure, len(lines))
+        stage.lines = len(lines)
+    sections = structure['sections']
+    functions = structure['functions']
+    loops = structure['loops']
+    cases = structure['cases']
     
     if verbose:
         print(f"Found {len(sections)} sections, {len(functions)} functions, {len(loops)} loops, {len(cases)} cases")
@@ -994,44 +2392,1330 @@ def process_script(script_path, keywords_path, output_path, verbose=False):
         for loop in loops:
             print(f"  Loop: {loop['type']} at line {loop['start'] + 1}")
     
-    # Process modifications
-    new_lines, stats = process_keyword_matching(new_lines, keywords, sections, functions, loops, orig_commented)
+    result = _comment_stages(lines, meta, structure, index, hits, timer,
+                             REPORT_MATCH_LIMIT if report_only else None)
+    if report_only:
+        return result
+    
+    _renumber_stage(result, timer)
+    _replacement_stage(result, timer, rules)
+    final_lines = _changelog_stage(result, timer)
+    # Fix indentation
+    regions = reindent_regions(result['journal'], index) if reindent == 'touched' else None
+    if lazy and not timer.enabled:
+        final_lines = iter_fixed_indentation(final_lines, meta, regions)
+    else:
+        with timer.stage('fix_indentation', final_lines) as stage:
+            final_lines = fix_indentation(final_lines, meta, regions)
+            stage.output = final_lines
+    
+    result.update(lines=final_lines, reindent_regions=regions)
+    return result
+
+def _comment_stages(lines, meta, structure, index, hits, timer, match_limit=None, messages=None):
+    """Run keyword matching, case branch and fully-commented handling over `lines`.
+
+    The edits go into a new EditJournal over `lines`; `meta` is updated in
+    place. `match_limit` caps the listed matches per keyword (see
+    process_keyword_matching); progress messages go to the `messages` list
+    when given. Returns the partial transform_lines result.
+    """
+    sections = structure['sections']
+    new_lines = EditJournal(lines)
+    new_lines.stage = 'keyword_matching'
+    with timer.stage('keyword_matching', new_lines) as stage:
+        new_lines, stats = process_keyword_matching(new_lines, hits, structure, index, None, meta, match_limit)
+        stage.output = new_lines
     # Handle case branches and cases
-    comment_case_branches_and_cases(new_lines, cases, keywords)
+    new_lines.stage = 'case_branches'
+    with timer.stage('case_branches', new_lines):
+        comment_case_branches_and_cases(new_lines, structure['cases'], hits, meta)
     # Check for fully commented structures (sections, functions, loops) and comment them if needed
-    fully_comented_sections, fully_comented_functions, fully_comented_loops, fully_comented_subsections = check_fully_commented_structures(
-        new_lines, sections, functions, loops, keywords
-    )
-    # Renumber active sections
-    renumber_map = renumber_sections(new_lines, sections, fully_comented_sections, fully_comented_subsections)
-    # Apply global replacements
-    global_replacements = apply_global_replacements(new_lines)
-    # Generate and insert changelog
-    changelog = generate_changelog(stats, sections, functions, fully_comented_sections,
-                                 fully_comented_functions, renumber_map, global_replacements)
-    final_lines = insert_changelog(new_lines, changelog)
-    # Fix indentation
-    final_lines = fix_indentation(final_lines)
+    new_lines.stage = 'fully_commented'
+    with timer.stage('fully_commented', new_lines):
+        fully_comented_sections, fully_comented_functions, fully_comented_loops, fully_comented_subsections = check_fully_commented_structures(
+            new_lines, sections, structure['functions'], structure['loops'], hits, meta, messages
+        )
+    
+    return {
+        'stats': stats,
+        'structure': structure,
+        'fully_commented_sections': fully_comented_sections,
+        'fully_commented_functions': fully_comented_functions,
+        'fully_commented_loops': fully_comented_loops,
+        'fully_commented_subsections': fully_comented_subsections,
+        'journal': new_lines,
+        'meta': meta,
+        'index': index
+    }
+
+def _renumber_stage(result, timer, stamp_lines=None):
+    """Renumber the active sections of a _comment_stages result."""
+    new_lines = result['journal']
+    new_lines.stage = 'renumber'
+    with timer.stage('renumber', new_lines):
+        result['renumber_map'] = renumber_sections(new_lines, result['structure']['sections'],
+                                                   result['fully_commented_sections'],
+                                                   result['fully_commented_subsections'], result['meta'],
+                                                   stamp_lines)
+    return result['renumber_map']
+
+def _replacement_stage(result, timer, rules=None):
+    """Apply the global replacement `rules` to a _comment_stages result."""
+    new_lines = result['journal']
+    new_lines.stage = 'global_replacements'
+    with timer.stage('global_replacements', new_lines):
+        result['global_replacements'], result['replacement_counts'] = apply_global_replacements(
+            new_lines, result['meta'], rules)
+    return result['global_replacements'], result['replacement_counts']
+
+def _changelog_text(result):
+    """Generate the changelog of a _comment_stages result."""
+    structure = result['structure']
+    result.setdefault('renumber_map', {})
+    result.setdefault('global_replacements', 0)
+    result.setdefault('replacement_counts', {})
+    return generate_changelog(result['stats'], structure['sections'], structure['functions'],
+                              result['fully_commented_sections'], result['fully_commented_functions'],
+                              result['renumber_map'], result['global_replacements'],
+                              result['replacement_counts'])
+
+def _changelog_stage(result, timer):
+    """Generate the changelog and insert it into the result's journal, which is returned.
+
+    A warning goes to the result's 'messages' list, if it has one.
+    """
+    new_lines = result['journal']
+    new_lines.stage = 'changelog'
+    with timer.stage('changelog', new_lines) as stage:
+        changelog = _changelog_text(result)
+        final_lines = insert_changelog(new_lines, changelog, result['meta'], result.get('messages'))
+        stage.output = final_lines
+    result['changelog'] = changelog
+    return final_lines
+
+class ScriptProcessor:
+    """Library entry point: parse a script once and apply keyword profiles to it.
+
+    The keyword-independent model (lines, line metadata and the full block
+    structure, found by `parse` called like parse_structure(lines, meta)) is
+    built once; every apply() works on its own copy, so one
+    processor can evaluate any number of profiles:
+
+        processor = ScriptProcessor.from_path("job.sh")
+        result = processor.process(KeywordMatcher(load_keywords(Path("keywords.txt"))))
+        text = processor.render(result)
+
+    process() is apply(), renumber() and replace() in turn; render(),
+    render_bytes(), write() and render_patch() add the changelog and produce
+    the output. Results are transform_lines-style dicts; summary() condenses
+    one into plain data. Progress messages are collected in the result's
+    'messages' list instead of being printed.
+
+    A result only holds what its keywords change: the line metadata is a
+    MetaOverlay, only the blocks with a hit are copied, and the replacement
+    rules run once over the original lines and once more only over the
+    lines a result edits. base() is the run without any hit; passed to
+    iter_lines(), its rendered output is reused for every other result.
+    """
+
+    def __init__(self, lines, name="<script>", parse=parse_structure):
+        self.name = str(name)
+        self.lines = lines
+        self.meta = build_line_meta(lines)
+        self.structure = parse(lines, self.meta)
+        self.index = StructureIndex(self.structure, len(lines))
+        self._stamp_lines = None
+        self._replacements = {}  # rules fingerprint -> shared replacements of the original lines
+        self._bases = {}  # rules fingerprint -> base()
+
+    @classmethod
+    def from_text(cls, text, name="<script>"):
+        return cls(text.splitlines(keepends=True), name)
+
+    @classmethod
+    def from_path(cls, script_path, cache=None):
+        """Read and parse a script; with a ResultCache, its cached parse tree is reused."""
+        script_path = Path(script_path)
+        if cache is None:
+            return cls.from_text(script_path.read_text(encoding="utf-8"), script_path.as_posix())
+        raw = script_path.read_bytes()
+        lines = raw.decode("utf-8").replace("\r\n", "\n").replace("\r", "\n").splitlines(keepends=True)
+        return cls(lines, script_path.as_posix(), functools.partial(cache.structure, cache.structure_key(raw)))
+
+    def hits(self, matcher):
+        """Return the HitIndex of `matcher` over the script."""
+        return HitIndex(self.lines, matcher)
+
+    def apply(self, matcher=None, hits=None, match_limit=None):
+        """Comment the lines and blocks `matcher` selects; return the result dict.
+
+        Pass `hits` instead when the HitIndex was already computed, e.g. by
+        ProfileMatcher.hit_indexes(processor.lines); `matcher` is then unused.
+        `match_limit` caps the listed matches per keyword, for reports.
+        """
+        if hits is None:
+            hits = self.hits(matcher)
+        # Only the blocks around a hit record commented lines
+        ids = set()
+        for i in hits.hits:
+            for node in self.index.enclosing(i):
+                ids.add(node['id'])
+                if node['kind'] == 'subsection':
+                    ids.add(self.index.section_of[node['id']]['id'])
+        structure = copy_structure(self.structure, ids)
+        index = self.index.rebind(structure, ids)
+        meta = MetaOverlay(self.meta)
+        result = {'messages': []}
+        result.update(_comment_stages(self.lines, meta, structure, index, hits, StageTimer(enabled=False),
+                                      match_limit, result['messages']))
+        return result
+
+    def renumber(self, result):
+        """Renumber the sections left active in `result`; return the renumber map."""
+        if self._stamp_lines is None:
+            self._stamp_lines = [i for i, line in enumerate(self.lines) if STAMP_COMMAND_PATTERN.match(line)]
+        return _renumber_stage(result, StageTimer(enabled=False), self._stamp_lines)
+
+    def _replaced(self, rules):
+        """Return {line: (text, LineInfo, occurrences per rule index)} for the original lines `rules` match."""
+        key = rules.fingerprint()
+        if key not in self._replacements:
+            found = {}
+            counts = [0] * len(rules.rules)
+            if rules.rules:
+                sub = rules._line_sub(counts)
+                seen = 0
+                previous = list(counts)
+                for i, line in enumerate(self.lines):
+                    updated = sub(line)
+                    total = sum(counts)
+                    if total == seen:
+                        continue
+                    found[i] = (updated, LineInfo(updated) if updated != line else self.meta[i],
+                                [now - before for now, before in zip(counts, previous)])
+                    seen = total
+                    previous = list(counts)
+            self._replacements[key] = found
+        return self._replacements[key]
+
+    def replace(self, result, rules=None):
+        """Apply the global replacement `rules`; return (lines changed, per-rule counts).
+
+        Lines `result` left as they were take the replacements shared by
+        every result; only the lines it edited are matched again.
+        """
+        rules = rules or DEFAULT_REPLACEMENT_RULES
+        shared = self._replaced(rules)
+        journal, meta = result['journal'], result['meta']
+        edited = {i for i in journal.edited() if journal[i] != self.lines[i]}
+        journal.stage = 'global_replacements'
+        counts = [0] * len(rules.rules)
+        sub = rules._line_sub(counts) if rules.rules else None
+        changed = 0
+        for i in sorted(edited.union(shared)):
+            if i in edited:
+                line = journal[i]
+                updated = sub(line) if sub else line
+                if updated != line:
+                    set_line(journal, meta, i, updated)
+                    changed += 1
+                continue
+            text, info, line_counts = shared[i]
+            for idx, count in enumerate(line_counts):
+                counts[idx] += count
+            if text != self.lines[i]:
+                journal[i] = text
+                meta[i] = info
+                changed += 1
+        result['global_replacements'] = changed
+        result['replacement_counts'] = _rule_counts(rules, counts)
+        return result['global_replacements'], result['replacement_counts']
+
+    def base(self, rules=None):
+        """Return the run without any keyword hit for `rules`, rendered once.
+
+        A dict with the processed 'result' and its output: the (text,
+        LineInfo) 'units' after the changelog is inserted, their 'rendered'
+        text, the open blocks ('states') before each unit and after the last,
+        the changelog 'splice' (start, stop, length) and the changelog
+        'markers' of the lines it was placed in.
+        """
+        rules = rules or DEFAULT_REPLACEMENT_RULES
+        key = rules.fingerprint()
+        if key not in self._bases:
+            result = self.apply(hits=HitIndex())
+            self.renumber(result)
+            self.replace(result, rules)
+            journal = result['journal']
+            markers = changelog_markers(journal)
+            journal = self._finished(result)
+            _, start, (stop, block), _ = journal.edits[-1]
+            units = [(text, info) for text, info in zip(journal, result['meta'])]
+            states = []
+            rendered = []
+            stack = None
+            for text, info in units:
+                states.append(stack)
+                outputs, stack = _indent_step(stack, text, info)
+                rendered.append(outputs[0] if len(outputs) == 1 else "".join(outputs))
+            states.append(stack)
+            self._bases[key] = {'result': result, 'units': units, 'rendered': rendered, 'states': states,
+                                'splice': (start, stop, len(block)), 'markers': markers}
+        return self._bases[key]
+
+    def process(self, matcher=None, rules=None, hits=None):
+        """Run the whole pipeline up to the output: apply, renumber and replace."""
+        result = self.apply(matcher, hits)
+        self.renumber(result)
+        self.replace(result, rules)
+        return result
+
+    def _finished(self, result):
+        if 'changelog' not in result:
+            _changelog_stage(result, StageTimer(enabled=False))
+        return result['journal']
+
+    def iter_lines(self, result, reindent='all', base=None):
+        """Yield the output lines of `result`, changelog included and re-indented.
+
+        With `base`, the base() for the rules `result` was processed with,
+        a fully re-indented output is built from the rendered base output:
+        only the lines that differ from it, and the lines after them until
+        the open blocks agree again, are re-indented.
+        """
+        if base is not None and reindent == 'all':
+            if result is base['result']:
+                return iter(base['rendered'])
+            if 'changelog' not in result:
+                return self._iter_on_base(result, base)
+        journal = self._finished(result)
+        regions = reindent_regions(journal, result['index']) if reindent == 'touched' else None
+        return iter_fixed_indentation(journal, result['meta'], regions)
+
+    def _iter_on_base(self, result, base):
+        journal, meta = result['journal'], result['meta']
+        base_journal = base['result']['journal']
+        differs = sorted(i for i in journal.edited() | base_journal.edited() if journal[i] != base_journal[i])
+        marker_lines, separator_lines = map(set, base['markers'])
+        for i in differs:
+            marker_lines.discard(i)
+            separator_lines.discard(i)
+            if CHANGELOG_MARKER in journal[i]:
+                marker_lines.add(i)
+            elif CHANGELOG_SEPARATOR in journal[i]:
+                separator_lines.add(i)
+        start, stop, block = changelog_splice(journal, _changelog_text(result),
+                                              (sorted(marker_lines), sorted(separator_lines)), result['messages'])
+        base_start, base_stop, base_length = base['splice']
+        if (start, stop) != (base_start, base_stop):
+            return self.iter_lines(result)
+        # Edits to the base units, as (first unit, end unit, new units) in order
+        shift = base_length - (base_stop - base_start)
+        edits = [(i if i < start else i + shift, (i if i < start else i + shift) + 1, [(journal[i], meta[i])])
+                 for i in differs if not start <= i < stop]
+        edits.append((start, start + base_length, [(text, LineInfo(text)) for text in block]))
+        edits.sort(key=lambda edit: edit[0])
+        return self._iter_edited_base(base, edits)
+
+    @staticmethod
+    def _iter_edited_base(base, edits):
+        units, rendered, states = base['units'], base['rendered'], base['states']
+        edits.append((len(units), len(units), ()))
+        stack = None
+        k = 0
+        for start, end, new in edits:
+            # Unchanged units render as in the base once the open blocks agree
+            while k < start and stack != states[k]:
+                outputs, stack = _indent_step(stack, *units[k])
+                yield from outputs
+                k += 1
+            if k < start:
+                yield from rendered[k:start]
+                stack = states[start]
+            for text, info in new:
+                outputs, stack = _indent_step(stack, text, info)
+                yield from outputs
+            k = end
+
+    def render(self, result, reindent='all'):
+        return "".join(self.iter_lines(result, reindent))
+
+    def render_bytes(self, result, reindent='all', encoding="utf-8"):
+        return self.render(result, reindent).encode(encoding)
+
+    def write(self, result, stream, reindent='all'):
+        """Write the output to a text `stream`."""
+        stream.writelines(self.iter_lines(result, reindent))
+
+    def render_patch(self, result, reindent='all'):
+        """Return the edits of `result` as a unified diff against the original script."""
+        journal = self._finished(result)
+        regions = reindent_regions(journal, result['index']) if reindent == 'touched' else None
+        return "".join(iter_unified_diff(journal, result['meta'], self.name, self.name, regions=regions))
+
+    def summary(self, result, output_path=None):
+        """Return the processing summary of `result` as plain data."""
+        return build_summary(self.name, output_path, result)
+
+def build_summary(script_path, output_path, result):
+    """Condense a transform_lines result into the summary dict print_summary shows."""
+    stats = result['stats']
+    return {
+        'script': str(script_path),
+        'output': None if output_path is None else str(output_path),
+        'lines_modified': stats['lines_modified'],
+        'sections_modified': len(stats['modified_sections']),
+        'functions_modified': len(stats['modified_functions']),
+        'sections_fully_commented': len(result['fully_commented_sections']),
+        'functions_fully_commented': len(result['fully_commented_functions']),
+        'global_replacements': result.get('global_replacements', 0),
+        'sections_renumbered': len(result.get('renumber_map', ()))
+    }
+
+# Matches listed per keyword in a report; deeply nested blocks attribute every
+# hit to each block around it, and 'keyword_match_counts' has the full counts
+REPORT_MATCH_LIMIT = 100
+
+def build_report(script_path, line_count, result):
+    """Convert a report-only transform_lines result into a JSON-serialisable dict."""
+    stats = result['stats']
+    return {
+        'script': str(script_path),
+        'lines': line_count,
+        'lines_modified': stats['lines_modified'],
+        'modified_sections': sorted(stats['modified_sections']),
+        'modified_functions': sorted(stats['modified_functions']),
+        'modified_loops': sorted(stats['modified_loops']),
+        'keyword_matches': stats['keyword_matches'],
+        'keyword_match_counts': stats['keyword_match_counts'],
+        'predicted_fully_commented': {
+            'sections': sorted(result['fully_commented_sections']),
+            'subsections': sorted(i + 1 for i in result['fully_commented_subsections']),
+            'functions': sorted(result['fully_commented_functions']),
+            'loops': sorted(result['fully_commented_loops'])
+        }
+    }
+
+def report_script(script_path, keywords_path, matcher=None, timings=False, prefilter=True):
+    """Audit a script without rewriting it.
+
+    Runs structure detection, keyword scanning and fully-commented prediction,
+    and returns the build_report dict (None if the script cannot be read).
+    With `prefilter`, a script without any keyword occurrence is not parsed,
+    as process_script would skip it: its report is empty. Progress messages
+    go to stderr so stdout can carry the JSON report.
+    """
+    timer = StageTimer(enabled=timings, trace_memory=False)
+    with contextlib.redirect_stdout(sys.stderr):
+        try:
+            with timer.stage('read') as stage:
+                if matcher is None:
+                    keywords = load_keywords(keywords_path)
+                    if not keywords:
+                        print("No keywords found!")
+                        return None
+                    matcher = KeywordMatcher(keywords)
+                raw = script_path.read_bytes()
+                skipped = prefilter and not matcher.search_bytes(raw)
+                # Decode with universal newlines, as read_text would
+                text = raw.decode("utf-8")
+                del raw
+                if "\r" in text:
+                    text = text.replace("\r\n", "\n").replace("\r", "\n")
+                lines = text.splitlines(keepends=True)
+                del text
+                stage.lines = len(lines)
+        except Exception as e:
+            print(f"Error reading files: {e}")
+            return None
+        result = transform_lines([] if skipped else lines, matcher, timer, report_only=True)
+    report = build_report(script_path, len(lines), result)
+    if skipped:
+        report['prefilter'] = 'skipped'
+    if timer.enabled:
+        report['timings'] = timer.report()
+    return report
+
+def process_script(script_path, keywords_path, output_path, verbose=False, matcher=None, cache=None,
+                   timings=False, journal_path=None, patch=False, prefilter=True, rules=None, reindent='all'):
+    """Main processing function.
+
+    Pass a prebuilt `matcher` to reuse a compiled keyword set across scripts;
+    otherwise keywords are loaded from `keywords_path`. With a ResultCache, an
+    unchanged script is served from the cache without being parsed. With
+    `timings`, every stage is measured (cache lookups are skipped) and the
+    records are returned under the summary's 'timings' key. With
+    `journal_path`, the edit journal is also exported there as JSON (cache
+    lookups are skipped as well). With `patch`, `output_path` receives a
+    unified diff of the edits instead of the full script. With `prefilter`, a
+    script without any keyword occurrence is not parsed: it is skipped (no
+    output is written) or, if it contains 'bdi' variants, only gets the global
+    replacements. `rules` is the ReplacementRules to apply (default: 'bdi' →
+    'war'). `reindent` is 'all' or 'touched' (see transform_lines). Returns a summary
+    dict, or None if the script could not be processed.
+    """
+    print(f"Processing: {script_path}")
+    timer = StageTimer(enabled=timings)
+    stop_tracing = timings and not tracemalloc.is_tracing()
+    if stop_tracing:
+        tracemalloc.start()
+    try:
+        return _process_script(script_path, keywords_path, output_path, verbose, matcher, cache, timer,
+                               journal_path, patch, prefilter, rules or DEFAULT_REPLACEMENT_RULES, reindent)
+    finally:
+        if stop_tracing:
+            tracemalloc.stop()
+
+def _process_script(script_path, keywords_path, output_path, verbose, matcher, cache, timer,
+                    journal_path=None, patch=False, prefilter=True, rules=DEFAULT_REPLACEMENT_RULES,
+                    reindent='all'):
+    # Load files
+    try:
+        with timer.stage('read') as stage:
+            if matcher is None:
+                keywords = load_keywords(keywords_path)
+                
+                if not keywords:
+                    print("No keywords found!")
+                    return
+                matcher = KeywordMatcher(keywords)
+            else:
+                keywords = matcher.keywords
+            
+            if prefilter:
+                has_keyword, has_replacement = prefilter_script(script_path, matcher, rules)
+                if not has_keyword:
+                    return _process_unmatched(script_path, output_path, has_replacement, patch, rules)
+            
+            raw = script_path.read_bytes()
+            cache_key = None
+            if cache is not None:
+                cache_key = cache.key(raw, keywords, rules, f"reindent={reindent}")
+                cached = None if timer.enabled or journal_path or patch else cache.get(cache_key, output_path)
+                if cached is not None:
+                    print(f"Cache hit - output written to: {output_path}")
+                    summary = dict(cached, script=str(script_path), output=str(output_path))
+                    print_summary(summary)
+                    return summary
+            
+            # Parse trees do not depend on the keywords, so they are cached even when results are not used
+            parse = parse_structure
+            if cache is not None and not timer.enabled:
+                parse = functools.partial(cache.structure, cache.structure_key(raw))
+            # Decode with universal newlines, as read_text would, dropping
+            # each copy of the script once the next one exists
+            text = raw.decode("utf-8")
+            del raw
+            if "\r" in text:
+                text = text.replace("\r\n", "\n").replace("\r", "\n")
+            lines = text.splitlines(keepends=True)
+            del text
+            stage.lines = len(lines)
+        
+        if verbose:
+            print(f"Loaded {len(keywords)} keywords: {keywords}")
+        print(f"Processing {len(lines)} lines...")
+        
+    except Exception as e:
+        print(f"Error reading files: {e}")
+        return
+    
+    result = transform_lines(lines, matcher, timer, verbose, lazy=True, rules=rules, reindent=reindent,
+                             parse=parse)
+    summary = build_summary(script_path, output_path, result)
+    # Only the edits, their line metadata and the lazy output are needed from
+    # here on; the block tree and stats are dropped before rendering
+    result = {key: result[key] for key in ('lines', 'journal', 'meta', 'reindent_regions')}
     # Write output
     try:
-        output_path.write_text("".join(final_lines), encoding="utf-8")
-        print(f"Output written to: {output_path}")
+        with timer.stage('write') as stage:
+            if patch:
+                label = script_path.as_posix()
+                write_lines_atomic(output_path, iter_unified_diff(result['journal'], result['meta'], label, label,
+                                                                  regions=result['reindent_regions']))
+            else:
+                write_lines_atomic(output_path, result['lines'])
+                stage.lines = len(result['lines']) if timer.enabled else 0
+        print(f"{'Patch' if patch else 'Output'} written to: {output_path}")
+        if journal_path:
+            journal = {'script': str(script_path), 'edits': result['journal'].to_records()}
+            write_lines_atomic(journal_path, [json.dumps(journal, indent=2), "\n"])
+            print(f"Edit journal written to: {journal_path}")
         
         # Print summary
-        print(f"\nSUMMARY:")
-        print(f"- Lines modified by keywords: {stats['lines_modified']}")
-        print(f"- Sections modified: {len(stats['modified_sections'])}")
-        print(f"- Functions modified: {len(stats['modified_functions'])}")
-        print(f"- Sections fully commented: {len(fully_comented_sections)}")
-        print(f"- Functions fully commented: {len(fully_comented_functions)}")
-        print(f"- Global replacements: {global_replacements}")
-        print(f"- Active sections renumbered: {len(renumber_map)}")
+        print_summary(summary)
         
     except Exception as e:
         print(f"Error writing output: {e}")
+        return
+    
+    if cache is not None and not patch:
+        cache.put(cache_key, output_path, summary)
+    if timer.enabled:
+        summary['timings'] = timer.report()
+        print_timings(summary['timings'])
+    return summary
+
+def _process_unmatched(script_path, output_path, has_replacement, patch=False, rules=None):
+    """Handle a script the prefilter found no keywords in.
+
+    Without replacement targets nothing is written; otherwise only the global
+    replacements are applied, with no changelog or re-indentation.
+    """
+    summary = {
+        'script': str(script_path),
+        'output': None,
+        'lines_modified': 0,
+        'sections_modified': 0,
+        'functions_modified': 0,
+        'sections_fully_commented': 0,
+        'functions_fully_commented': 0,
+        'global_replacements': 0,
+        'sections_renumbered': 0,
+        'prefilter': 'skipped'
+    }
+    if not has_replacement:
+        print("No keyword hits - skipped")
+        return summary
+    
+    journal = EditJournal(script_path.read_text(encoding="utf-8").splitlines(keepends=True))
+    journal.stage = 'global_replacements'
+    summary['global_replacements'], _ = apply_global_replacements(journal, None, rules)
+    if patch:
+        label = script_path.as_posix()
+        write_lines_atomic(output_path, iter_unified_diff(journal, None, label, label))
+    else:
+        write_lines_atomic(output_path, journal)
+    print(f"No keyword hits - only global replacements applied, written to: {output_path}")
+    summary.update(output=str(output_path), prefilter='replacements_only')
+    print_summary(summary)
+    return summary
+
+# Per-worker keyword matcher and result cache, set up once by _init_batch_worker
+_worker_matcher = None
+_worker_cache = None
+_worker_timings = False
+_worker_prefilter = True
+_worker_rules = None
+_worker_reindent = 'all'
+_worker_profiles = None
+_worker_profile_options = {}
+
+def _report_batch_job(script_path):
+    """Audit one script inside a pool worker."""
+    try:
+        return report_script(script_path, None, matcher=_worker_matcher, timings=_worker_timings,
+                             prefilter=_worker_prefilter)
+    except Exception as e:
+        print(f"Error processing {script_path}: {e}", file=sys.stderr)
+        return None
+
+def _init_batch_worker(keywords, cache_dir=None, timings=False, prefilter=True, rules=None, reindent='all'):
+    global _worker_matcher, _worker_cache, _worker_timings, _worker_prefilter, _worker_rules, _worker_reindent
+    _worker_matcher = KeywordMatcher(keywords)
+    _worker_cache = ResultCache(cache_dir) if cache_dir is not None else None
+    _worker_timings = timings
+    _worker_prefilter = prefilter
+    _worker_rules = rules
+    _worker_reindent = reindent
+
+def _process_batch_job(job):
+    """Process one script inside a pool worker, keeping its console output quiet."""
+    script_path, output_path, patch = job
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            return process_script(script_path, None, output_path, matcher=_worker_matcher,
+                                  cache=_worker_cache, timings=_worker_timings, patch=patch,
+                                  prefilter=_worker_prefilter, rules=_worker_rules, reindent=_worker_reindent)
+    except Exception as e:
+        print(f"Error processing {script_path}: {e}")
+        return None
+
+def report_batch(scripts, keywords_path, jobs=None, timings=False, prefilter=True):
+    """Audit many scripts across a process pool and return their reports."""
+    keywords = load_keywords(keywords_path)
+    if not keywords:
+        print("No keywords found!", file=sys.stderr)
+        return []
+    
+    jobs = jobs or os.cpu_count() or 1
+    if jobs == 1:
+        _init_batch_worker(keywords, None, timings, prefilter)
+        return [_report_batch_job(script) for script in scripts]
+    chunksize = max(1, len(scripts) // (jobs * 4))
+    with ProcessPoolExecutor(max_workers=jobs, initializer=_init_batch_worker,
+                             initargs=(keywords, None, timings, prefilter)) as executor:
+        return list(executor.map(_report_batch_job, scripts, chunksize=chunksize))
+
+def load_profiles(paths):
+    """Load keyword files as profiles named after their stems; return a ProfileMatcher, or None on error."""
+    profiles = {}
+    for path in paths:
+        if path.stem in profiles:
+            print(f"Error: duplicate profile name '{path.stem}' ({path})")
+            return None
+        keywords = load_keywords(path)
+        if not keywords:
+            print(f"Error: no keywords found in profile {path}")
+            return None
+        profiles[path.stem] = keywords
+    return ProfileMatcher(profiles)
+
+def evaluate_profiles(script_path, profiles, report_only=False, output_dir=None, rules=None, reindent='all',
+                      cache=None):
+    """Parse a script once and evaluate every keyword profile of `profiles` (a ProfileMatcher) on it.
+
+    Each profile entry of the returned dict is the build_report impact report
+    with `report_only`, otherwise the processing summary. With `output_dir`,
+    each profile's modified script is written to output_dir/<profile>/<name>.
+    A ResultCache supplies the cached parse tree. Profiles without a hit all
+    get the processor's base() run; the others are rendered from it.
+    """
+    processor = ScriptProcessor.from_path(script_path, cache)
+    entries = {}
+    empty = None  # the report shared by profiles without a hit
+    base = None
+    for name, hits in profiles.hit_indexes(processor.lines).items():
+        if report_only:
+            if not hits.hits:
+                empty = empty or processor.apply(hits=hits)
+            result = processor.apply(hits=hits, match_limit=REPORT_MATCH_LIMIT) if hits.hits else empty
+            entry = build_report(script_path, len(processor.lines), result)
+            del entry['script'], entry['lines']
+        else:
+            if base is None and (output_dir is not None or not hits.hits):
+                base = processor.base(rules)
+            result = processor.process(rules=rules, hits=hits) if hits.hits else base['result']
+            output_path = None
+            if output_dir is not None:
+                output_path = Path(output_dir) / name / script_path.name
+                output_path.parent.mkdir(parents=True, exist_ok=True)
+                write_lines_atomic(output_path, processor.iter_lines(result, reindent, base))
+            entry = processor.summary(result, output_path)
+            del entry['script']
+        entries[name] = entry
+    return {'script': str(script_path), 'lines': len(processor.lines), 'profiles': entries}
+
+def _init_profile_worker(profiles, report_only=False, output_dir=None, rules=None, reindent='all',
+                         cache_dir=None):
+    global _worker_profiles, _worker_profile_options
+    _worker_profiles = ProfileMatcher(profiles)
+    _worker_profile_options = {'report_only': report_only, 'output_dir': output_dir, 'rules': rules,
+                               'reindent': reindent,
+                               'cache': ResultCache(cache_dir) if cache_dir is not None else None}
+
+def _profile_batch_job(script_path):
+    """Evaluate the profiles on one script inside a pool worker."""
+    try:
+        return evaluate_profiles(script_path, _worker_profiles, **_worker_profile_options)
+    except Exception as e:
+        print(f"Error processing {script_path}: {e}", file=sys.stderr)
+        return None
+
+def profile_batch(scripts, profiles, jobs=None, report_only=False, output_dir=None, rules=None, reindent='all',
+                  cache=None):
+    """Evaluate the profiles of a ProfileMatcher on many scripts across a process pool."""
+    cache_dir = cache.directory if cache is not None else None
+    initargs = (profiles.profiles, report_only, output_dir, rules, reindent, cache_dir)
+    jobs = min(jobs or os.cpu_count() or 1, len(scripts))
+    if jobs <= 1:
+        _init_profile_worker(*initargs)
+        return [_profile_batch_job(script) for script in scripts]
+    chunksize = max(1, len(scripts) // (jobs * 4))
+    with ProcessPoolExecutor(max_workers=jobs, initializer=_init_profile_worker,
+                             initargs=initargs) as executor:
+        return list(executor.map(_profile_batch_job, scripts, chunksize=chunksize))
+
+# Tokens recorded by the keyword-occurrence index
+TOKEN_PATTERN = re.compile(r'[A-Za-z_][A-Za-z0-9_]*')
+
+def occurrence_rows(processor):
+    """Yield (token, line, commented, section, subsection, function, loop) for a parsed script.
+
+    Every distinct token of every line is reported once with its 1-based line
+    number, whether the line was already commented, and the innermost
+    section number, stamp subsection, function name and loop enclosing it.
+    """
+    index = processor.index
+    for i, line in enumerate(processor.lines):
+        tokens = set(TOKEN_PATTERN.findall(line))
+        if not tokens:
+            continue
+        owners = {}
+        for node in index.enclosing(i):
+            owners.setdefault(node['kind'], node)
+        section = owners.get('section')
+        subsection = owners.get('subsection')
+        function = owners.get('function')
+        loop = owners.get('loop')
+        context = (
+            processor.meta[i].commented,
+            section['num'] if section else None,
+            subsection['description'] if subsection else None,
+            function['name'] if function else None,
+            f"{loop['type']} at line {loop['start'] + 1}" if loop else None
+        )
+        for token in sorted(tokens):
+            yield (token, i + 1) + context
+
+def _init_index_worker(cache_dir=None):
+    global _worker_cache
+    _worker_cache = ResultCache(cache_dir) if cache_dir is not None else None
+
+def _index_script_job(script_path):
+    """Parse one script inside a pool worker; return (line count, occurrence rows), or None on error."""
+    try:
+        processor = ScriptProcessor.from_path(script_path, _worker_cache)
+        return len(processor.lines), list(occurrence_rows(processor))
+    except Exception as e:
+        print(f"Error indexing {script_path}: {e}", file=sys.stderr)
+        return None
+
+class KeywordIndex:
+    """SQLite index of every token occurrence across a script corpus.
+
+    build() parses new and changed scripts (detected by mtime and size, then
+    confirmed by content hash) and stores each token with the blocks
+    enclosing it; query() then answers keyword → locations without touching
+    the scripts. The index is rebuilt from scratch when TOOL_VERSION changes.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+        CREATE TABLE IF NOT EXISTS scripts (
+            id INTEGER PRIMARY KEY, path TEXT UNIQUE, mtime_ns INTEGER, size INTEGER,
+            sha256 TEXT, lines INTEGER);
+        CREATE TABLE IF NOT EXISTS occurrences (
+            script_id INTEGER, token TEXT, line INTEGER, commented INTEGER,
+            section INTEGER, subsection TEXT, function TEXT, loop TEXT);
+        CREATE INDEX IF NOT EXISTS occurrences_token ON occurrences (token);
+        CREATE INDEX IF NOT EXISTS occurrences_script ON occurrences (script_id);
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(str(self.path))
+        self.db.executescript(self.SCHEMA)
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'tool_version'").fetchone()
+        if row is None or row[0] != TOOL_VERSION:
+            with self.db:
+                self.db.execute("DELETE FROM occurrences")
+                self.db.execute("DELETE FROM scripts")
+                self.db.execute("INSERT OR REPLACE INTO meta VALUES ('tool_version', ?)", (TOOL_VERSION,))
+
+    def close(self):
+        self.db.close()
+
+    def build(self, scripts, jobs=None, cache=None):
+        """Bring the index up to date for `scripts`; return counts of indexed/unchanged/removed/failed scripts."""
+        counts = {'indexed': 0, 'unchanged': 0, 'removed': 0, 'failed': 0}
+        known = {path: (script_id, mtime_ns, size, sha256) for script_id, path, mtime_ns, size, sha256
+                 in self.db.execute("SELECT id, path, mtime_ns, size, sha256 FROM scripts")}
+        pending = []
+        for script in scripts:
+            path = str(script.resolve())
+            try:
+                st = script.stat()
+            except OSError:
+                counts['failed'] += 1
+                continue
+            entry = known.get(path)
+            if entry is not None and entry[1:3] == (st.st_mtime_ns, st.st_size):
+                counts['unchanged'] += 1
+                continue
+            sha256 = hashlib.sha256(script.read_bytes()).hexdigest()
+            if entry is not None and entry[3] == sha256:
+                # Touched but not changed
+                with self.db:
+                    self.db.execute("UPDATE scripts SET mtime_ns = ?, size = ? WHERE id = ?",
+                                    (st.st_mtime_ns, st.st_size, entry[0]))
+                counts['unchanged'] += 1
+                continue
+            pending.append((script, path, st, sha256))
+        
+        cache_dir = cache.directory if cache is not None else None
+        scripts_to_parse = [script for script, _, _, _ in pending]
+        jobs = min(jobs or os.cpu_count() or 1, len(pending))
+        if jobs <= 1:
+            _init_index_worker(cache_dir)
+            parsed = map(_index_script_job, scripts_to_parse)
+            executor = None
+        else:
+            executor = ProcessPoolExecutor(max_workers=jobs, initializer=_init_index_worker, initargs=(cache_dir,))
+            parsed = executor.map(_index_script_job, scripts_to_parse, chunksize=max(1, len(pending) // (jobs * 4)))
+        try:
+            for (script, path, st, sha256), job in zip(pending, parsed):
+                if job is None:
+                    counts['failed'] += 1
+                    continue
+                line_count, rows = job
+                with self.db:
+                    self._forget(path)
+                    cursor = self.db.execute(
+                        "INSERT INTO scripts (path, mtime_ns, size, sha256, lines) VALUES (?, ?, ?, ?, ?)",
+                        (path, st.st_mtime_ns, st.st_size, sha256, line_count))
+                    script_id = cursor.lastrowid
+                    self.db.executemany("INSERT INTO occurrences VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                        ((script_id,) + row for row in rows))
+                counts['indexed'] += 1
+        finally:
+            if executor is not None:
+                executor.shutdown()
+        
+        # Drop scripts that no longer exist
+        with self.db:
+            for path in known:
+                if not os.path.exists(path):
+                    self._forget(path)
+                    counts['removed'] += 1
+        return counts
+
+    def _forget(self, path):
+        row = self.db.execute("SELECT id FROM scripts WHERE path = ?", (path,)).fetchone()
+        if row is not None:
+            self.db.execute("DELETE FROM occurrences WHERE script_id = ?", row)
+            self.db.execute("DELETE FROM scripts WHERE id = ?", row)
+
+    def query(self, keywords):
+        """Return {keyword: [location dicts]} for exact tokens, or glob patterns containing * ? [."""
+        results = {}
+        for keyword in keywords:
+            operator = "GLOB" if glob.has_magic(keyword) else "="
+            rows = self.db.execute(
+                f"SELECT s.path, o.token, o.line, o.commented, o.section, o.subsection, o.function, o.loop "
+                f"FROM occurrences o JOIN scripts s ON s.id = o.script_id "
+                f"WHERE o.token {operator} ? ORDER BY s.path, o.line, o.token", (keyword,))
+            results[keyword] = [{
+                'script': path,
+                'token': token,
+                'line': line,
+                'commented': bool(commented),
+                'section': section,
+                'subsection': subsection,
+                'function': function,
+                'loop': loop
+            } for path, token, line, commented, section, subsection, function, loop in rows]
+        return results
+
+def write_report(report, output_path=None):
+    """Print a JSON report, or write it to `output_path`."""
+    text = json.dumps(report, indent=2)
+    if output_path is None:
+        print(text)
+    else:
+        output_path.write_text(text + "\n", encoding="utf-8")
+        print(f"Report written to: {output_path}", file=sys.stderr)
+
+def default_output_path(script_path):
+    """Return the `<stem>_modified<suffix>` output path next to the input script."""
+    stem = script_path.stem
+    suffix = script_path.suffix
+    output_name = f"{stem}_modified{suffix}" if suffix else f"{stem}_modified"
+    return script_path.parent / output_name
+
+def patch_output_path(script_path):
+    """Return the `<name>.patch` output path next to the input script."""
+    return script_path.with_name(f"{script_path.name}.patch")
+
+def collect_scripts(paths):
+    """Expand files, directories and glob patterns into a sorted list of scripts.
+
+    Directories are searched recursively for `.sh` files. Previously generated
+    `_modified` outputs are skipped.
+    """
+    scripts = set()
+    for path in paths:
+        if path.is_dir():
+            candidates = path.rglob("*.sh")
+        elif glob.has_magic(str(path)):
+            candidates = (Path(p) for p in glob.glob(str(path), recursive=True))
+        else:
+            candidates = [path]
+        for candidate in candidates:
+            if candidate.is_file() and not candidate.stem.endswith("_modified"):
+                scripts.add(candidate)
+    return sorted(scripts)
+
+def process_batch(scripts, keywords_path, jobs=None, cache=None, timings=False, patch=False, prefilter=True,
+                  rules=None, reindent='all'):
+    """Process many scripts across a process pool and print an aggregate summary.
+
+    With `patch`, each script gets a unified diff next to it instead of a
+    `_modified` copy.
+    """
+    keywords = load_keywords(keywords_path)
+    if not keywords:
+        print("No keywords found!")
+        return []
+    
+    jobs = jobs or os.cpu_count() or 1
+    work = [(script, patch_output_path(script) if patch else default_output_path(script), patch)
+            for script in scripts]
+    print(f"Batch processing {len(work)} scripts with {jobs} workers...")
+    started = time.perf_counter()
+    
+    cache_dir = cache.directory if cache is not None else None
+    if jobs == 1:
+        _init_batch_worker(keywords, cache_dir, timings, prefilter, rules, reindent)
+        results = [_process_batch_job(job) for job in work]
+    else:
+        chunksize = max(1, len(work) // (jobs * 4))
+        with ProcessPoolExecutor(max_workers=jobs, initializer=_init_batch_worker,
+                                 initargs=(keywords, cache_dir, timings, prefilter, rules, reindent)) as executor:
+            results = list(executor.map(_process_batch_job, work, chunksize=chunksize))
+    if cache is not None:
+        cache.evict()
+    
+    elapsed = time.perf_counter() - started
+    succeeded = [r for r in results if r is not None]
+    failed = [str(script) for (script, _, _), r in zip(work, results) if r is None]
+    
+    print(f"\nBATCH SUMMARY:")
+    print(f"- Scripts processed: {len(succeeded)}/{len(work)} in {elapsed:.2f}s")
+    print(f"- Scripts without keyword hits: {sum(1 for r in succeeded if r.get('prefilter'))}")
+    for key, label in [('lines_modified', "Lines modified by keywords"),
+                       ('sections_modified', "Sections modified"),
+                       ('functions_modified', "Functions modified"),
+                       ('sections_fully_commented', "Sections fully commented"),
+                       ('functions_fully_commented', "Functions fully commented"),
+                       ('global_replacements', "Global replacements")]:
+        print(f"- {label}: {sum(r[key] for r in succeeded)}")
+    for script in failed:
+        print(f"  FAILED: {script}")
+    if timings:
+        totals = {}
+        for result in succeeded:
+            for record in result.get('timings', ()):
+                total = totals.setdefault(record['stage'], {'stage': record['stage'], 'seconds': 0.0,
+                                                            'lines': 0, 'peak_bytes': 0})
+                total['seconds'] += record['seconds']
+                total['lines'] += record['lines']
+                total['peak_bytes'] = max(total['peak_bytes'], record['peak_bytes'])
+        print_timings(list(totals.values()))
+    return results
+
+# Per-worker state for the daemon: the default keyword file and warm matchers and rule sets per file
+_daemon_keywords = None
+_daemon_matchers = {}
+_daemon_rule_sets = {}
+
+def _init_daemon_worker(keywords_path, cache_dir=None, rules=None, cache_max_bytes=DEFAULT_CACHE_MAX_MB * 1024 * 1024):
+    global _daemon_keywords, _worker_cache, _worker_rules
+    _daemon_keywords = Path(keywords_path)
+    _worker_rules = rules
+    _worker_cache = ResultCache(cache_dir, cache_max_bytes) if cache_dir is not None else None
+    _daemon_matcher(_daemon_keywords)
+
+def _daemon_matcher(keywords_path):
+    """Return the compiled matcher for a keyword file, rebuilding it only when the file changes."""
+    st = keywords_path.stat()
+    key = (str(keywords_path), st.st_mtime_ns, st.st_size)
+    matcher = _daemon_matchers.get(key)
+    if matcher is None:
+        keywords = load_keywords(keywords_path)
+        if not keywords:
+            raise ValueError(f"No keywords found in {keywords_path}")
+        matcher = KeywordMatcher(keywords)
+        _daemon_matchers[key] = matcher
+    return matcher
+
+def _daemon_rules(rules_path):
+    """Return the replacement rules of a rule file, reloading them only when the file changes."""
+    st = rules_path.stat()
+    key = (str(rules_path), st.st_mtime_ns, st.st_size)
+    rules = _daemon_rule_sets.get(key)
+    if rules is None:
+        with contextlib.redirect_stdout(io.StringIO()) as out:
+            rules = load_replacement_rules(rules_path)
+        if rules is None:
+            raise ValueError(out.getvalue().strip())
+        _daemon_rule_sets[key] = rules
+    return rules
+
+def _daemon_job(request):
+    """Handle one process/report request inside a daemon worker."""
+    out = io.StringIO()
+    try:
+        script_path = Path(request['script'])
+        profile = Path(request['profile']) if request.get('profile') else _daemon_keywords
+        matcher = _daemon_matcher(profile)
+        if request.get('report_only'):
+            with contextlib.redirect_stdout(out):
+                result = report_script(script_path, None, matcher=matcher, prefilter=request.get('prefilter', True))
+        else:
+            patch = request.get('patch', False)
+            if request.get('output'):
+                output_path = Path(request['output'])
+            else:
+                output_path = patch_output_path(script_path) if patch else default_output_path(script_path)
+            rules = _daemon_rules(Path(request['rules'])) if request.get('rules') else _worker_rules
+            with contextlib.redirect_stdout(out):
+                result = process_script(script_path, None, output_path, matcher=matcher, cache=_worker_cache,
+                                        patch=patch, prefilter=request.get('prefilter', True), rules=rules,
+                                        reindent=request.get('reindent', 'all'))
+    except Exception as e:
+        return {'ok': False, 'error': f"{type(e).__name__}: {e}"}
+    if result is None:
+        # process_script and report_script print why they gave up last
+        printed = out.getvalue().strip().splitlines()
+        reason = printed[-1] if printed else "no result"
+        return {'ok': False, 'error': f"Could not process {request.get('script')}: {reason}"}
+    return {'ok': True, 'result': result}
+
+def _resolved(response):
+    """Return a finished Future holding `response`."""
+    future = Future()
+    future.set_result(response)
+    return future
+
+class _DaemonHandler(socketserver.StreamRequestHandler):
+    """Reads one JSON request per line and writes one JSON response per line, in request order.
+
+    Requests go to the worker pool as they are read, so a client may send
+    many before reading any response; a writer thread sends each response
+    once it and every earlier one are done.
+    """
+
+    def handle(self):
+        pending = queue.Queue(maxsize=self.server.max_pending)
+        writer = threading.Thread(target=self._write_responses, args=(pending,), daemon=True)
+        writer.start()
+        try:
+            for raw in self.rfile:
+                if not raw.strip():
+                    continue
+                try:
+                    request = json.loads(raw)
+                except ValueError:
+                    pending.put(_resolved({'ok': False, 'error': "Invalid JSON request"}))
+                else:
+                    pending.put(self.server.dispatch(request))
+        finally:
+            pending.put(None)
+            writer.join()
+        self.server.evict()
+
+    def _write_responses(self, pending):
+        connected = True
+        while True:
+            future = pending.get()
+            if future is None:
+                return
+            try:
+                response = future.result()
+            except Exception as e:
+                response = {'ok': False, 'error': f"{type(e).__name__}: {e}"}
+            # Keep draining after the client hangs up so the reader never blocks
+            if not connected:
+                continue
+            try:
+                self.wfile.write((json.dumps(response) + "\n").encode("utf-8"))
+                if pending.empty():
+                    self.wfile.flush()
+            except OSError:
+                connected = False
+
+class ProcessingDaemon(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Unix-socket server that processes scripts on a warm worker pool.
+
+    Requests are JSON lines: {"script": path} with optional "output",
+    "profile" (keyword file), "rules" (replacement rule file), "patch",
+    "prefilter", "reindent" and "report_only"; {"command": "ping"} and
+    {"command": "shutdown"} control the daemon. Workers compile each keyword
+    profile and rule file once and keep it for later requests. With a
+    ResultCache, the cache is evicted after each client disconnects.
+    """
+    daemon_threads = True
+
+    def __init__(self, socket_path, keywords_path, jobs=None, cache=None, rules=None):
+        self.socket_path = Path(socket_path)
+        if self.socket_path.exists():
+            # Only a stale socket may be replaced, never a live daemon's
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+                try:
+                    probe.connect(str(self.socket_path))
+                except OSError:
+                    self.socket_path.unlink()
+                else:
+                    raise OSError(errno.EADDRINUSE, f"A daemon is already listening on {self.socket_path}")
+        super().__init__(str(self.socket_path), _DaemonHandler)
+        jobs = jobs or os.cpu_count() or 1
+        self.max_pending = 4 * jobs
+        self.cache = cache
+        self._evict_lock = threading.Lock()
+        initargs = (keywords_path, None, rules) if cache is None else (keywords_path, cache.directory, rules,
+                                                                       cache.max_bytes)
+        self.executor = ProcessPoolExecutor(max_workers=jobs, initializer=_init_daemon_worker, initargs=initargs)
+
+    def dispatch(self, request):
+        """Return a Future of the response to one request."""
+        command = request.get('command', 'process')
+        if command == 'ping':
+            return _resolved({'ok': True, 'version': TOOL_VERSION})
+        if command == 'shutdown':
+            threading.Thread(target=self.shutdown, daemon=True).start()
+            return _resolved({'ok': True})
+        if command != 'process' or not request.get('script'):
+            return _resolved({'ok': False, 'error': f"Unsupported request: {request}"})
+        return self.executor.submit(_daemon_job, request)
+
+    def evict(self):
+        if self.cache is not None:
+            with self._evict_lock:
+                self.cache.evict()
+
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown()
+        if self.socket_path.exists():
+            self.socket_path.unlink()
+
+def serve(socket_path, keywords_path, jobs=None, cache=None, rules=None):
+    """Run the processing daemon until it is shut down or interrupted."""
+    if not hasattr(socket, "AF_UNIX"):
+        print("Error: daemon mode needs Unix domain socket support")
+        sys.exit(1)
+    try:
+        daemon = ProcessingDaemon(socket_path, keywords_path, jobs, cache, rules)
+    except OSError as e:
+        print(f"Error: cannot listen on {socket_path}: {e}")
+        sys.exit(1)
+    print(f"Listening on {socket_path} (keywords: {keywords_path})")
+    try:
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        daemon.server_close()
+
+def submit(socket_path, requests):
+    """Send requests to a running daemon and return the responses in order.
+
+    Requests are written from a separate thread while responses are read,
+    so the daemon works on all of them at once.
+    """
+    requests = list(requests)
+    responses = []
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+        conn.connect(str(socket_path))
+
+        def send():
+            try:
+                with conn.makefile("wb") as stream:
+                    for request in requests:
+                        stream.write((json.dumps(request) + "\n").encode("utf-8"))
+                conn.shutdown(socket.SHUT_WR)
+            except OSError:
+                pass  # The daemon went away; reading the responses reports it
+
+        sender = threading.Thread(target=send, daemon=True)
+        sender.start()
+        with conn.makefile("rb") as stream:
+            for _ in requests:
+                line = stream.readline()
+                if not line:
+                    raise ConnectionError(f"connection closed after {len(responses)} of {len(requests)} responses")
+                responses.append(json.loads(line))
+        sender.join()
+    return responses
 
 def main():
     args = parse_args()
+    cache = None if args.no_cache else ResultCache(args.cache_dir, args.cache_max_mb * 1024 * 1024)
+    rules = None
+    if args.rules is not None:
+        rules = load_replacement_rules(args.rules)
+        if rules is None:
+            sys.exit(1)
+    
+    if args.serve is not None:
+        serve(args.serve, args.keywords, args.jobs, cache, rules)
+        return
+    
+    if args.submit is not None:
+        scripts = collect_scripts(args.script) if args.batch else [args.script]
+        requests = [{
+            'script': str(script.resolve()),
+            'output': str(args.output.resolve()) if args.output and not args.batch else None,
+            'profile': str(args.profile.resolve()) if args.profile else None,
+            'rules': str(args.rules.resolve()) if args.rules_given else None,
+            'patch': args.patch,
+            'prefilter': args.prefilter,
+            'reindent': args.reindent,
+            'report_only': args.report_only
+        } for script in scripts]
+        try:
+            responses = submit(args.submit, requests)
+        except OSError as e:
+            print(f"Error: daemon at {args.submit} failed: {e}")
+            sys.exit(1)
+        for request, response in zip(requests, responses):
+            if not response['ok']:
+                print(f"FAILED: {request['script']}: {response['error']}")
+            elif args.report_only:
+                print(json.dumps(response['result'], indent=2))
+            else:
+                result = response['result']
+                print(f"Processed: {result['script']} -> {result['output'] or 'skipped, no keyword hits'} "
+                      f"({result['lines_modified']} lines modified)")
+        sys.exit(0 if all(response['ok'] for response in responses) else 1)
+    
+    if args.query is not None:
+        if not args.index_db.exists():
+            print(f"Error: Index not found: {args.index_db} (build it with --build-index)")
+            sys.exit(1)
+        index = KeywordIndex(args.index_db)
+        try:
+            write_report(index.query(args.query), args.output)
+        finally:
+            index.close()
+        return
+    
+    if args.build_index:
+        scripts = collect_scripts(args.script) if args.batch else [args.script]
+        index = KeywordIndex(args.index_db)
+        try:
+            counts = index.build(scripts, args.jobs, cache)
+        finally:
+            index.close()
+        print(f"Index {args.index_db}: {counts['indexed']} indexed, {counts['unchanged']} unchanged, "
+              f"{counts['removed']} removed, {counts['failed']} failed")
+        if cache is not None:
+            cache.evict()
+        sys.exit(1 if counts['failed'] else 0)
+    
+    if args.profiles:
+        profiles = load_profiles(args.profiles)
+        if profiles is None:
+            sys.exit(1)
+        scripts = collect_scripts(args.script) if args.batch else [args.script]
+        if not scripts:
+            print("Error: No scripts found")
+            sys.exit(1)
+        reports = profile_batch(scripts, profiles, args.jobs, args.report_only, args.profile_outputs, rules,
+                                args.reindent, cache)
+        found = [r for r in reports if r is not None]
+        if found:
+            write_report(found if args.batch else found[0], args.output)
+        sys.exit(0 if len(found) == len(reports) else 1)
+    
+    if args.batch:
+        scripts = collect_scripts(args.script)
+        if not scripts:
+            print("Error: No scripts found")
+            sys.exit(1)
+        if not args.keywords.exists():
+            print(f"Error: Keywords file not found: {args.keywords}")
+            sys.exit(1)
+        if args.report_only:
+            reports = report_batch(scripts, args.keywords, args.jobs, args.timings, args.prefilter)
+            write_report([r for r in reports if r is not None], args.output)
+            sys.exit(0 if reports and all(reports) else 1)
+        results = process_batch(scripts, args.keywords, args.jobs, cache, args.timings, args.patch,
+                                args.prefilter, rules, args.reindent)
+        sys.exit(0 if results and all(results) else 1)
     
     if not args.script.exists():
         print(f"Error: Script file not found: {args.script}")
@@ -1041,7 +3725,18 @@ def main():
         print(f"Error: Keywords file not found: {args.keywords}")
         sys.exit(1)
     
-    process_script(args.script, args.keywords, args.output, args.verbose)
+    if args.report_only:
+        report = report_script(args.script, args.keywords, timings=args.timings, prefilter=args.prefilter)
+        if report is None:
+            sys.exit(1)
+        write_report(report, args.output)
+        return
+    
+    process_script(args.script, args.keywords, args.output, args.verbose, cache=cache, timings=args.timings,
+                   journal_path=args.journal, patch=args.patch, prefilter=args.prefilter, rules=rules,
+                   reindent=args.reindent)
+    if cache is not None:
+        cache.evict()
 
 if __name__ == "__main__":
     main()